@@ -0,0 +1,340 @@
+import argparse
+import functools
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from main import DB1B
+
+
+class SyntheticMarketData:
+    """Deterministic synthetic DB1B market files.
+
+    Airport traffic follows a Zipf distribution, and each of the largest airports is the hub of a major carrier that
+    carries most of the traffic to and from it.  A share of the passengers fly ULCCs, and some markets have much more
+    traffic in one direction than the other, so that passenger flow validation has routes to report.
+    """
+
+    MAJOR_CARRIERS = ['AA', 'DL', 'UA', 'WN', 'AS', 'B6', 'HA']
+    ULCCS = ['NK', 'F9', 'G4', 'SY', 'MX', 'XP']
+    INVALID_CARRIER = '--'
+
+    def __init__(self, airports=300, metros=20, carriers=12, markets=10000, rows_per_quarter=1000000, quarters=1,
+                 ulcc_share=0.15, hub_share=0.6, asymmetric_share=0.05, invalid_share=0.002, start_year=2023, seed=0):
+        assert airports >= 2 * metros
+        assert carriers >= 2
+        assert 0 < markets <= airports * (airports - 1) // 2
+        assert rows_per_quarter > 0 and quarters > 0
+        self._airports = airports
+        self._metros = metros
+        self._markets = markets
+        self._rows_per_quarter = rows_per_quarter
+        self._quarters = quarters
+        self._ulcc_share = ulcc_share
+        self._hub_share = hub_share
+        self._asymmetric_share = asymmetric_share
+        self._invalid_share = invalid_share
+        self._start_year = start_year
+        self._seed = seed
+
+        ulccs = max(1, min(len(self.ULCCS), round(carriers * ulcc_share)))
+        majors = carriers - ulccs
+        self._ulccs = self.ULCCS[:ulccs]
+        self._carriers = (self.MAJOR_CARRIERS + [f'C{i}' for i in range(max(0, majors - len(self.MAJOR_CARRIERS)))])[:majors] + self._ulccs
+        self._airport_codes = [self._airport_code(i) for i in range(airports)]
+
+    def metro_areas(self):
+        # The largest airports anchor the metros, and each takes one or two of the smaller airports as well.
+        rng = np.random.default_rng([self._seed, 1])
+        secondary = rng.permutation(np.arange(self._metros, self._airports))
+        metro_areas = {}
+        position = 0
+        for i in range(self._metros):
+            count = 1 + int(rng.integers(0, 2))
+            metro_areas[f'M{i:02d}'] = [self._airport_codes[i]] + [self._airport_codes[j] for j in secondary[position:position + count]]
+            position += count
+        return metro_areas
+
+    def ulccs(self):
+        return list(self._ulccs)
+
+    def write(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        rng = np.random.default_rng([self._seed, 0])
+        airport_weights = 1 / np.arange(1, self._airports + 1)
+        coordinates = rng.uniform([0, 0], [2600, 1200], (self._airports, 2))
+        origins, destinations = self._sample_markets(rng, airport_weights)
+        miles = np.maximum(np.round(np.hypot(*(coordinates[origins] - coordinates[destinations]).T)), 50)
+        market_weights = airport_weights[origins] * airport_weights[destinations] * rng.lognormal(0, 1, self._markets)
+        market_weights /= market_weights.sum()
+        forward_shares = np.where(rng.random(self._markets) < self._asymmetric_share, rng.choice([0.15, 0.85], self._markets), 0.5)
+        hub_carriers = self._hub_carriers(origins, destinations)
+
+        paths = []
+        for i in range(self._quarters):
+            year, quarter = self._start_year + i // 4, i % 4 + 1
+            path = os.path.join(directory, f'db1b-{year}-q{quarter}.csv')
+            self._quarter(rng, year, quarter, origins, destinations, miles, market_weights, forward_shares, hub_carriers).to_csv(path, index=False)
+            paths.append(path)
+        return paths
+
+    @staticmethod
+    def _airport_code(index):
+        letters = ''
+        for _ in range(3):
+            index, remainder = divmod(index, 26)
+            letters = chr(ord('A') + remainder) + letters
+        return letters
+
+    def _hub_carriers(self, origins, destinations):
+        # Each major carrier hubs at some of the largest airports; a market's hub carrier is that of its larger airport.
+        majors = len(self._carriers) - len(self._ulccs)
+        larger = np.minimum(origins, destinations)
+        return np.where(larger < 3 * majors, larger % majors, -1)
+
+    def _quarter(self, rng, year, quarter, origins, destinations, miles, market_weights, forward_shares, hub_carriers):
+        rows = self._rows_per_quarter
+        markets = rng.choice(self._markets, rows, p=market_weights)
+        forward = rng.random(rows) < forward_shares[markets]
+        majors = len(self._carriers) - len(self._ulccs)
+
+        draw = rng.random(rows)
+        carriers = rng.integers(0, majors, rows)
+        hub = hub_carriers[markets]
+        carriers = np.where((draw < self._hub_share) & (hub >= 0), hub, carriers)
+        ulcc = draw > 1 - self._ulcc_share
+        carriers = np.where(ulcc, majors + rng.integers(0, len(self._ulccs), rows), carriers)
+        carrier_codes = np.array(self._carriers + [self.INVALID_CARRIER])[np.where(rng.random(rows) < self._invalid_share, len(self._carriers), carriers)]
+
+        passengers = rng.geometric(0.6, rows).astype(float)
+        fares = passengers * (60 + 0.11 * miles[markets]) * np.where(ulcc, 0.6, 1) * rng.lognormal(0, 0.35, rows)
+        airports = np.array(self._airport_codes)
+        return pd.DataFrame({
+            'ITIN_ID': np.arange(rows),
+            'YEAR': year,
+            'QUARTER': quarter,
+            'ORIGIN': airports[np.where(forward, origins[markets], destinations[markets])],
+            'DEST': airports[np.where(forward, destinations[markets], origins[markets])],
+            'TICKET_CARRIER': carrier_codes,
+            'PASSENGERS': passengers,
+            'MARKET_FARE': np.round(fares, 2),
+            'NONSTOP_MILES': miles[markets],
+        })
+
+    def _sample_markets(self, rng, airport_weights):
+        # Markets are distinct unordered airport pairs, drawn in proportion to the traffic of both airports.
+        probabilities = airport_weights / airport_weights.sum()
+        pairs = np.empty((0, 2), dtype=np.int64)
+        while len(pairs) < self._markets:
+            draws = rng.choice(self._airports, (2 * self._markets, 2), p=probabilities)
+            draws = np.sort(draws[draws[:, 0] != draws[:, 1]], axis=1)
+            combined = np.concatenate([pairs, draws])
+            _, first = np.unique(combined, axis=0, return_index=True)
+            pairs = combined[np.sort(first)]
+        pairs = pairs[:self._markets]
+        return pairs[:, 0], pairs[:, 1]
+
+
+class _StageRecorder:
+    """Wall time and peak traced memory of pipeline stages, which may be nested and called more than once."""
+
+    def __init__(self, trace_memory):
+        self._trace_memory = trace_memory
+        self._open = []
+        self.stages = {}
+
+    def start(self, name):
+        if self._trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._open:
+                self._open[-1]['Peak'] = max(self._open[-1]['Peak'], peak)
+            tracemalloc.reset_peak()
+        else:
+            current = 0
+        self._open.append({'Name': name, 'Start': time.perf_counter(), 'Memory': current, 'Peak': current})
+        self.stages.setdefault(name, {'Calls': 0, 'Seconds': 0.0, 'Peak MB': 0.0})
+
+    def stop(self, name):
+        stage = self._open.pop()
+        assert stage['Name'] == name
+        seconds = time.perf_counter() - stage['Start']
+        peak = 0
+        if self._trace_memory:
+            peak = max(stage['Peak'], tracemalloc.get_traced_memory()[1])
+            if self._open:
+                self._open[-1]['Peak'] = max(self._open[-1]['Peak'], peak)
+            tracemalloc.reset_peak()
+        record = self.stages[name]
+        record['Calls'] += 1
+        record['Seconds'] += seconds
+        record['Peak MB'] = max(record['Peak MB'], (peak - stage['Memory']) / 1024 / 1024)
+
+    def wrap(self, db1b, name, stage=None):
+        method = getattr(db1b, name)
+        stage = stage or name
+
+        @functools.wraps(method)
+        def wrapped(*args, **kwargs):
+            self.start(stage)
+            result = method(*args, **kwargs)
+            self.stop(stage)
+            return result
+
+        setattr(db1b, name, wrapped)
+
+
+# The stages of DB1B.enrich that are timed, along with writing the output
+STAGES = ['_get_fresh_data', '_filter_for_share', '_add_fare_per_pax', '_add_shares', '_add_distance_premiums',
+          '_filter_at_end', '_enrich_shared', '_reorder_output_columns']
+WRITE_STAGE = 'Write output'
+
+
+def run_benchmark(data, directory, trace_memory, shared_enrichment=False):
+    input_paths = data.write(os.path.join(directory, 'input'))
+    output_path = os.path.join(directory, 'output.csv')
+    db1b = DB1B(output_path, input_paths, shared_enrichment=shared_enrichment)
+    db1b._configuration['Metro areas'] = data.metro_areas()
+    db1b._configuration['ULCCs'] = data.ulccs()
+    db1b._compile_configuration()
+
+    recorder = _StageRecorder(trace_memory)
+    for name in STAGES:
+        recorder.wrap(db1b, name)
+    # Timed by itself, since the flow validation is waited for between the enrichment and the write
+    recorder.wrap(db1b, '_write_output', stage=WRITE_STAGE)
+
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    recorder.start('enrich')
+    db1b.enrich()
+    recorder.stop('enrich')
+    seconds = time.perf_counter() - started
+    if trace_memory:
+        tracemalloc.stop()
+
+    return {
+        'Input rows': sum(len(pd.read_csv(path, usecols=['YEAR'])) for path in input_paths),
+        'Markets': len(db1b._full_df),
+        'Filtered markets': len(db1b._filtered_df),
+        'Output rows': len(pd.read_csv(output_path, usecols=[0])),
+        'Seconds': seconds,
+        'Stages': recorder.stages,
+    }
+
+
+def run(args):
+    results = {
+        'Commit': _commit(),
+        'Date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'Python': platform.python_version(),
+        'pandas': pd.__version__,
+        'NumPy': np.__version__,
+        'Shared enrichment': args.shared_enrichment,
+        'Runs': [],
+    }
+    for rows in args.rows:
+        parameters = {
+            'airports': args.airports,
+            'metros': args.metros,
+            'carriers': args.carriers,
+            'markets': args.markets,
+            'rows_per_quarter': rows,
+            'quarters': args.quarters,
+            'seed': args.seed,
+        }
+        data = SyntheticMarketData(**parameters)
+        timings = []
+        for _ in range(args.repeat):
+            with tempfile.TemporaryDirectory() as directory:
+                timings.append(run_benchmark(data, directory, trace_memory=False, shared_enrichment=args.shared_enrichment))
+        run_result = min(timings, key=lambda timing: timing['Seconds'])
+        if not args.skip_memory:
+            # Tracing memory slows the pipeline down, so memory is measured in a run of its own.
+            with tempfile.TemporaryDirectory() as directory:
+                memory = run_benchmark(data, directory, trace_memory=True, shared_enrichment=args.shared_enrichment)
+            for name, stage in run_result['Stages'].items():
+                stage['Peak MB'] = memory['Stages'][name]['Peak MB']
+        else:
+            for stage in run_result['Stages'].values():
+                del stage['Peak MB']
+        run_result['Parameters'] = parameters
+        results['Runs'].append(run_result)
+        print(f'{rows} rows x {args.quarters} quarters: {run_result["Seconds"]:.2f} s')
+        for name, stage in run_result['Stages'].items():
+            memory = f'  {stage["Peak MB"]:.0f} MB peak' if 'Peak MB' in stage else ''
+            print(f'  {name:<24} {stage["Seconds"]:8.2f} s{memory}')
+
+    with open(args.results, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.results) as f:
+        results = json.load(f)
+    baseline_runs = {json.dumps(run['Parameters'], sort_keys=True): run for run in baseline['Runs']}
+    print(f'{baseline["Commit"]} -> {results["Commit"]}')
+    for run_result in results['Runs']:
+        baseline_run = baseline_runs.get(json.dumps(run_result['Parameters'], sort_keys=True))
+        if baseline_run is None:
+            continue
+        print(f'{run_result["Parameters"]["rows_per_quarter"]} rows x {run_result["Parameters"]["quarters"]} quarters: '
+              f'{baseline_run["Seconds"]:.2f} s -> {run_result["Seconds"]:.2f} s ({_change(baseline_run["Seconds"], run_result["Seconds"])})')
+        for name, stage in run_result['Stages'].items():
+            if name in baseline_run['Stages']:
+                print(f'  {name:<24} {baseline_run["Stages"][name]["Seconds"]:8.2f} s -> {stage["Seconds"]:8.2f} s '
+                      f'({_change(baseline_run["Stages"][name]["Seconds"], stage["Seconds"])})')
+
+
+def _change(before, after):
+    return f'{(after / before - 1) * 100:+.1f}%' if before else 'n/a'
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark DB1B enrichment on synthetic market data.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='time and memory-profile the pipeline at several sizes')
+    run_parser.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000, 5000000],
+                            help='rows per quarter; the pipeline is benchmarked once per value')
+    run_parser.add_argument('--quarters', type=int, default=1)
+    run_parser.add_argument('--airports', type=int, default=300)
+    run_parser.add_argument('--metros', type=int, default=20)
+    run_parser.add_argument('--carriers', type=int, default=12)
+    run_parser.add_argument('--markets', type=int, default=10000)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--repeat', type=int, default=1, help='time each size this many times and keep the fastest')
+    run_parser.add_argument('--skip-memory', action='store_true', help='do not make a separate run to measure memory')
+    run_parser.add_argument('--shared-enrichment', action='store_true')
+    run_parser.add_argument('--results', default='benchmark-results.json', help='path to write the results to')
+
+    compare_parser = subparsers.add_parser('compare', help='compare two results files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == '__main__':
+    main()
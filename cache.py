@@ -0,0 +1,228 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import pandas as pd
+
+
+class DataFileCache:
+    """On-disk cache of consolidated DB1B data files, keyed by file contents and ingestion configuration."""
+
+    DEFAULT_MAX_SIZE_MB = 10240
+    _FORMAT_VERSION = 2
+    _DATA_SUFFIX = '.feather'
+    _METADATA_SUFFIX = '.json'
+    # Maps each input file hashed so far to its hash, along with the size and modification time it had when hashed
+    _FINGERPRINTS_NAME = 'fingerprints.index'
+
+    def __init__(self, directory, max_size_mb=DEFAULT_MAX_SIZE_MB):
+        assert max_size_mb > 0
+        self._directory = directory
+        self._max_size = max_size_mb * 1024 * 1024
+
+    def clear(self):
+        for key in self._keys():
+            self._remove(key)
+        try:
+            os.remove(self._fingerprints_path())
+        except FileNotFoundError:
+            pass
+
+    def entries(self):
+        entries = []
+        for key in self._keys():
+            metadata = self._read_metadata(key)
+            if metadata is None:
+                continue
+            metadata['Key'] = key
+            metadata['Size'] = self._entry_size(key)
+            entries.append(metadata)
+        return sorted(entries, key=lambda entry: entry['Last used'], reverse=True)
+
+    def get(self, key):
+        metadata = self._read_metadata(key)
+        if metadata is None:
+            return None
+        try:
+            df = pd.read_feather(self._data_path(key))
+        except FileNotFoundError:
+            return None
+        metadata['Last used'] = time.time()
+        self._write_metadata(key, metadata)
+        return df, metadata
+
+    def fingerprint(self, input_path):
+        """Returns a hash of the file's contents, hashing the file again only if its size or modification time changed."""
+        path = os.path.abspath(input_path)
+        stat = os.stat(path)
+        fingerprints = self._read_fingerprints()
+        known = fingerprints.get(path)
+        if known is not None and known['Size'] == stat.st_size and known['Modified'] == stat.st_mtime_ns:
+            return known['Fingerprint']
+
+        fingerprint = hashlib.blake2b(digest_size=20)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                fingerprint.update(block)
+        # Another process may have recorded other files since the index was read.  Files that no longer exist are
+        # dropped from it, so that it holds at most one entry per existing file.
+        fingerprints = {known_path: known for known_path, known in self._read_fingerprints().items()
+                        if os.path.exists(known_path)}
+        fingerprints[path] = {'Size': stat.st_size, 'Modified': stat.st_mtime_ns, 'Fingerprint': fingerprint.hexdigest()}
+        os.makedirs(self._directory, exist_ok=True)
+        temporary_path = f'{self._fingerprints_path()}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump(fingerprints, f)
+        os.replace(temporary_path, self._fingerprints_path())
+        return fingerprints[path]['Fingerprint']
+
+    def key(self, input_path, configuration):
+        fingerprint = hashlib.blake2b(digest_size=20)
+        fingerprint.update(json.dumps([self._FORMAT_VERSION, self.fingerprint(input_path), configuration],
+                                      sort_keys=True).encode())
+        return fingerprint.hexdigest()
+
+    def exists(self):
+        return os.path.isdir(self._directory)
+
+    def put(self, key, df, metadata):
+        # The directory is only created once there is something to put in it.
+        os.makedirs(self._directory, exist_ok=True)
+        metadata = dict(metadata, **{'Last used': time.time()})
+        temporary_path = f'{self._data_path(key)}.{os.getpid()}.tmp'
+        df.to_feather(temporary_path)
+        os.replace(temporary_path, self._data_path(key))
+        self._write_metadata(key, metadata)
+        self._evict()
+
+    def _data_path(self, key):
+        return os.path.join(self._directory, key + self._DATA_SUFFIX)
+
+    def _entry_size(self, key):
+        size = 0
+        for path in [self._data_path(key), self._metadata_path(key)]:
+            try:
+                size += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        return size
+
+    def _evict(self):
+        entries = self.entries()
+        total_size = sum(entry['Size'] for entry in entries)
+        # Entries are ordered most recently used first, so the least recently used are dropped first.
+        while total_size > self._max_size and entries:
+            entry = entries.pop()
+            self._remove(entry['Key'])
+            total_size -= entry['Size']
+
+    def _fingerprints_path(self):
+        return os.path.join(self._directory, self._FINGERPRINTS_NAME)
+
+    def _keys(self):
+        if not self.exists():
+            return []
+        return [name[:-len(self._METADATA_SUFFIX)] for name in os.listdir(self._directory)
+                if name.endswith(self._METADATA_SUFFIX)]
+
+    def _metadata_path(self, key):
+        return os.path.join(self._directory, key + self._METADATA_SUFFIX)
+
+    def _read_metadata(self, key):
+        try:
+            with open(self._metadata_path(key)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _read_fingerprints(self):
+        try:
+            with open(self._fingerprints_path()) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _remove(self, key):
+        # Another process sharing the cache may already have removed the entry.
+        for path in [self._metadata_path(key), self._data_path(key)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _write_metadata(self, key, metadata):
+        temporary_path = f'{self._metadata_path(key)}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump(metadata, f)
+        os.replace(temporary_path, self._metadata_path(key))
+
+
+class StageCache(DataFileCache):
+    """On-disk cache of the outputs of the enrichment pipeline's stages, alongside the consolidated data files.
+
+    A stage's output is keyed by the keys of the stage outputs it reads and by the configuration it reads, so its key
+    changes whenever any earlier stage's would.  The entries share the data files' directory and size limit.
+    """
+
+    # Feather stores only columns, so an output's index, which later stages and the output may carry, is stored as one.
+    _INDEX_COLUMN = '__index__'
+
+    def explain(self, stage, input_keys, configuration):
+        """Says why a stage's output is not cached, by comparing it with the stage's most recently used output."""
+        previous = next((entry for entry in self.entries() if entry.get('Stage') == stage), None)
+        if previous is None:
+            return 'no earlier output of the stage is cached'
+        changed = [name for name in sorted(set(configuration) | set(previous['Configuration']))
+                   if configuration.get(name) != previous['Configuration'].get(name)]
+        if changed:
+            return f'its configuration changed: {", ".join(changed)}'
+        changed = [name for name in input_keys if input_keys[name] != previous['Inputs'].get(name)]
+        if changed:
+            return f'its input changed: {", ".join(changed)}'
+        return 'its output was evicted'
+
+    def get(self, key):
+        cached = super().get(key)
+        if cached is None:
+            return None
+        df, metadata = cached
+        return df.set_index(self._INDEX_COLUMN).rename_axis(None), metadata
+
+    def put(self, key, df, metadata):
+        super().put(key, df.reset_index(names=self._INDEX_COLUMN), metadata)
+
+    @classmethod
+    def stage_key(cls, stage, input_keys, configuration):
+        fingerprint = hashlib.blake2b(digest_size=20)
+        fingerprint.update(json.dumps([cls._FORMAT_VERSION, stage, input_keys, configuration], sort_keys=True).encode())
+        return fingerprint.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or clear the cache of consolidated DB1B data files and stages.')
+    parser.add_argument('command', choices=['list', 'clear'])
+    parser.add_argument('cache_dir', help='path to the cache directory')
+    args = parser.parse_args()
+
+    cache = DataFileCache(args.cache_dir)
+    if not cache.exists():
+        print(f'No cache at {args.cache_dir}')
+        return
+    if args.command == 'clear':
+        cache.clear()
+        return
+
+    entries = cache.entries()
+    for entry in entries:
+        last_used = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['Last used']))
+        # Stage outputs are named by their stage, and data files by their quarter and path.
+        description = entry['Stage'] if 'Stage' in entry else f'Q{entry["QUARTER"]} {entry["YEAR"]}'
+        print(f'{entry["Key"][:12]}  {description}  {entry["Size"] / 1024 / 1024:.1f} MB  '
+              f'last used {last_used}  {entry.get("Input path", "")}'.rstrip())
+    print(f'{len(entries)} entries, {sum(entry["Size"] for entry in entries) / 1024 / 1024:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import glob
+import os
+import zipfile
+from contextlib import contextmanager
+
+
+# Data files are CSVs, either as downloaded from BTS in zip archives, or unzipped and optionally recompressed.  pandas
+# decompresses gzip, bz2, xz, and zstd files itself, by extension; zstd requires `zstandard`.
+DATA_FILE_EXTENSIONS = ['.csv', '.zip', '.gz', '.bz2', '.xz', '.zst']
+
+
+def expand_input_paths(input_paths):
+    """Expands directories to the data files in them and glob patterns to the paths they match, each in sorted order.
+
+    Other paths are kept as given, so a misspelled path fails when it is read rather than silently matching nothing.
+    """
+    expanded = []
+    for input_path in input_paths:
+        if os.path.isdir(input_path):
+            expanded.extend(sorted(os.path.join(input_path, name) for name in os.listdir(input_path)
+                                   if _is_data_file(os.path.join(input_path, name))))
+        elif any(character in input_path for character in '*?['):
+            matches = sorted(path for path in glob.glob(input_path) if os.path.isfile(path))
+            assert matches, f'No data files match {input_path}'
+            expanded.extend(matches)
+        else:
+            expanded.append(input_path)
+    return expanded
+
+
+@contextmanager
+def open_data_file(input_path):
+    """Yields something pd.read_csv can read the data file from, decompressing it as it is read.
+
+    A zip archive's CSV is streamed out of the archive rather than extracted to disk.  Other files are yielded as
+    paths, which pandas decompresses by their extension.
+    """
+    if os.path.splitext(input_path)[1].lower() != '.zip':
+        yield input_path
+        return
+    with zipfile.ZipFile(input_path) as archive:
+        # BTS archives hold the data alongside a readme
+        members = [member for member in archive.namelist() if member.lower().endswith('.csv')]
+        assert len(members) == 1, f'Expected one CSV in {input_path}, found {members}'
+        with archive.open(members[0]) as f:
+            yield f
+
+
+def _is_data_file(path):
+    return os.path.isfile(path) and os.path.splitext(path)[1].lower() in DATA_FILE_EXTENSIONS
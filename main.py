@@ -1,52 +1,204 @@
+import argparse
+import copy
 import json
-import sys
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 
+from cache import DataFileCache, StageCache
+from inputs import expand_input_paths, open_data_file
+from profiling import NullProfiler, StageProfiler, peak_rss
+from sketches import fare_sketch, merge_sketches, sketch_quantiles
+from validation import FlowValidationError, concerning_flows, validate_flows
+from writers import OUTPUT_FORMATS, output_writer
+
 
 class DB1B:
-    def __init__(self, output_path, input_paths):
+    _DATA_FILE_COLUMNS = ['YEAR', 'QUARTER', 'ORIGIN', 'DEST', 'TICKET_CARRIER', 'PASSENGERS', 'MARKET_FARE', 'NONSTOP_MILES']
+    _DATA_FILE_DTYPES = {
+        'YEAR': 'int16',
+        'QUARTER': 'int8',
+        'ORIGIN': 'category',
+        'DEST': 'category',
+        'TICKET_CARRIER': 'category',
+        'PASSENGERS': 'float32',
+        'MARKET_FARE': 'float64',
+        'NONSTOP_MILES': 'float32',
+    }
+    # The order enrichment puts rows in, which is also the order of the output
+    _MARKET_ORDER = ['ORIGIN', 'DEST', 'NONSTOP_MILES', 'TICKET_CARRIER']
+    _MERGE_COLUMNS = ['ORIGIN', 'DEST', 'TICKET_CARRIER']
+    _FARE_SKETCH_KEYS = ['ORIGIN', 'DEST', 'TICKET_CARRIER']
+    # Columns that low-memory mode keeps at full precision, since later stages filter, group, or merge on them
+    _LOW_MEMORY_EXACT_COLUMNS = ['NONSTOP_MILES', 'Pax/day', 'Adj pax/day', 'Revenue/day', 'Total revenue/day',
+                                 'Metro pax/day', 'Metro share', 'Distance bucket', 'Metro distance bucket']
+    # The configuration the daily values and the share filter depend on
+    _DAILY_VALUES_SECTIONS = ['Ancillary revenue per passenger', 'Extra seats', 'Metro areas']
+    _SHARE_FILTER_SECTIONS = ['Filters at beginning', 'Metro areas']
+
+    def __init__(self, output_path, input_paths, chunk_size=None, parallel=False, workers=None, cache_dir=None,
+                 cache_max_size_mb=DataFileCache.DEFAULT_MAX_SIZE_MB, debug=False, shared_enrichment=False, profile=False,
+                 output_format=None, float_precision=None, flow_report_path=None, strict_flow_validation=False,
+                 low_memory=False, memory_budget_mb=None, shards=None, cache_stages=False, explain_cache=False,
+                 fare_quantiles=False):
         self._load_configuration()
-        assert output_path.endswith('.csv')
         self._output_path = output_path
-        assert len(input_paths) > 0
-        self._input_paths = input_paths
+        self._writer = output_writer(output_path, output_format, float_precision)
+        self._input_paths = expand_input_paths(input_paths)
+        assert len(self._input_paths) > 0, f'No data files found in {input_paths}'
+        assert chunk_size is None or chunk_size > 0
+        self._chunk_size = chunk_size
+        assert workers is None or workers > 0
+        self._parallel = parallel
+        self._workers = workers
+        self._cache = DataFileCache(cache_dir, cache_max_size_mb) if cache_dir is not None else None
+        assert not cache_stages or cache_dir is not None, 'Stages are cached in the cache directory'
+        assert not explain_cache or cache_stages
+        self._stage_cache = StageCache(cache_dir, cache_max_size_mb) if cache_stages else None
+        self._explain_cache = explain_cache
+        self._debug = debug
+        self._shared_enrichment = shared_enrichment
+        self._profiler = StageProfiler() if profile else NullProfiler()
         self._full_df = None
         self._analysis_length = 0
+        self._quarters = []
+        self._flow_report_path = flow_report_path
+        self._strict_flow_validation = strict_flow_validation
+        self._flow_validator = None
+        self._flow_validations = []
+        self._low_memory = low_memory
+        assert memory_budget_mb is None or memory_budget_mb > 0
+        self._memory_budget_mb = memory_budget_mb
+        assert shards is None or shards > 0
+        assert shards is None or not shared_enrichment, 'Sharded enrichment cannot be combined with shared enrichment'
+        self._shards = shards
+        # Totals spanning shards, set while a shard is enriched
+        self._shard_totals = None
+        self._fare_quantiles = fare_quantiles
+        # The fare sketches of the data files read so far
+        self._fare_sketches = []
+        self._share_filter_rows = None
+        # The unfiltered and filtered data enriched up to the filters at end, kept by enrich_frames
+        self._enriched_dfs = None
 
     def enrich(self):
-        self._get_fresh_data()
+        try:
+            # Low-memory mode defers copies until one side of them is modified, which most never are.
+            with pd.option_context('mode.copy_on_write', self._low_memory or pd.options.mode.copy_on_write):
+                if self._stage_cache is not None:
+                    merged_df = self._enrich_memoized()
+                else:
+                    with self._profiler.stage('_get_fresh_data') as stage:
+                        self._get_fresh_data()
+                        stage.output(self._full_df.shape)
+                    merged_df = self._enrich_fresh_data()
+                    self._finish_flow_validation()
+                if self._fare_quantiles:
+                    merged_df = self._add_fare_quantiles(merged_df)
+                self._write_output(merged_df)
+        finally:
+            # Left running only if the run failed before its flow validations were collected
+            if self._flow_validator is not None:
+                self._flow_validator.shutdown(cancel_futures=True)
+                self._flow_validator, self._flow_validations = None, []
+        if self._low_memory or self._memory_budget_mb is not None:
+            self._report_peak_memory()
 
-        def enrich_df(full_df):
-            df = self._add_fare_per_pax(full_df.copy())
-            df = self._add_shares(df, full_df.copy())
-            df = self._add_distance_premiums(df)
-            df = self._filter_at_end(df)
-            return df
+    @property
+    def configuration(self):
+        return copy.deepcopy(self._configuration)
+
+    def configured(self, configuration):
+        # A copy that enriches under the given configuration, which has to read data files the same way
+        db1b = copy.copy(self)
+        db1b._configuration = copy.deepcopy(configuration)
+        db1b._compile_configuration()
+        assert db1b._ingestion_configuration() == self._ingestion_configuration(), \
+            'The invalid carriers, which the data files are read with, cannot be changed'
+        return db1b
 
-        unfiltered_df = enrich_df(self._full_df.copy())
-        filtered_df = enrich_df(self._filtered_df.copy())
+    def enrich_frames(self, consolidated_df, quarters, base=None):
+        # A base's enrichment of the same data is filtered again when only the filters at end differ from it.
+        self.prepare_frames(consolidated_df, quarters, base)
+        if self._shards is not None or self._shared_enrichment:
+            return self._enrich_fresh_data()
+        sections = set(self._configuration).union(base._configuration if base is not None else [])
+        if base is not None and base._enriched_dfs is not None and \
+                not self._configuration_changed(base, sections.difference(['Filters at end', 'Passenger flow validation'])):
+            self._enriched_dfs = base._enriched_dfs
+        else:
+            self._enriched_dfs = (self._enrich_variant(self._full_df, 'unfiltered', filter_at_end=False),
+                                  self._enrich_variant(self._filtered_df, 'filtered', filter_at_end=False))
+        unfiltered_df, filtered_df = [self._filter_at_end(df) for df in self._enriched_dfs]
+        with self._profiler.stage('Merge', unfiltered_df.shape) as stage:
+            merged_df = self._reorder_output_columns(self._merge_enrichments(unfiltered_df, filtered_df))
+            stage.output(merged_df.shape)
+        return merged_df
 
-        merge_columns = ['ORIGIN', 'DEST', 'TICKET_CARRIER']
-        unfiltered_df = unfiltered_df[[col for col in unfiltered_df.columns if col in merge_columns or ('yield' not in col and 'premium' not in col)]]
-        filtered_df = filtered_df[[col for col in filtered_df.columns if col in merge_columns or 'yield' in col or 'premium' in col]]
-        merged_df = unfiltered_df.merge(filtered_df, how='left', on=merge_columns)
+    def flow_validation_report(self):
+        # Waits for the flow validations of the data files ingested so far and reports them, returning the report
+        return self._finish_flow_validation()
 
-        merged_df = self._reorder_output_columns(merged_df)
-        merged_df.to_csv(self._output_path)
+    def ingest(self, input_paths=None):
+        # Returns the consolidated data of the given data files, or else of the input files, and the quarters it covers
+        read_quarters = len(self._quarters)
+        df = self._get_consolidated_data(input_paths=input_paths)
+        return df, self._quarters[read_quarters:]
+
+    def prepare_frames(self, consolidated_df, quarters, base=None):
+        # Those of a base that prepared the same data are reused where the configuration they depend on is unchanged.
+        self._analysis_length, self._quarters = 0, []
+        for year, quarter in quarters:
+            self._add_to_analysis_length(year, quarter)
+        if base is None or self._configuration_changed(base, self._DAILY_VALUES_SECTIONS):
+            self._full_df = self._add_daily_values(self._categorize_keys(consolidated_df))
+        else:
+            self._full_df = base._full_df
+        if base is None or self._configuration_changed(base, self._SHARE_FILTER_SECTIONS):
+            with self._profiler.stage('_filter_for_share', self._full_df.shape) as stage:
+                self._share_filter_rows = self._share_filter_mask(self._full_df)
+                stage.output((int(self._share_filter_rows.sum()), len(self._full_df.columns)))
+        else:
+                self._share_filter_rows = base._share_filter_rows
+        self._filtered_df = self._full_df[self._share_filter_rows].reset_index(drop=True)
+
+    def report_flow_validations(self, report):
+        # Reports a flow validation report again, flagging routes by this object's thresholds
+        flow_validation = self._configuration['Passenger flow validation']
+        self._report_flow_validations(report.assign(Concerning=concerning_flows(
+            report, flow_validation['Quantity different'], flow_validation['Percent different'])))
+
+    def write(self, df, output_path=None):
+        # Writes an output to the output path, or to another path in the same format
+        self._write_output(df, output_path)
+
+    def _add_daily_values(self, df):
+        df['Pax/day'] = df['PASSENGERS'] / (0.1 * self._analysis_length)  # Data is a 10% sample
+        df['Adj pax/day'] = df['Pax/day'] / self._lookup_categories(df['TICKET_CARRIER'], self._density_bonuses)
+        df['Revenue/day'] = df['MARKET_FARE'] / (0.1 * self._analysis_length)
+        df['Ancillary revenue'] = self._lookup_categories(df['TICKET_CARRIER'], self._ancillary_revenues)
+        df['Total revenue/day'] = df['Revenue/day'] + df['Ancillary revenue'] * df['Pax/day']
+        df.drop('PASSENGERS', axis=1, inplace=True)
+        df.drop('MARKET_FARE', axis=1, inplace=True)
+        df.drop('Ancillary revenue', axis=1, inplace=True)
+        df['Origin metro'] = self._metros(df['ORIGIN'])
+        df['Destination metro'] = self._metros(df['DEST'])
+        return df
 
     def _add_distance_premiums(self, existing_df):
-        df = existing_df.copy()
-        market_distance_df = df[['ORIGIN', 'DEST', 'TICKET_CARRIER', 'NONSTOP_MILES', 'Revenue/day', 'Total revenue/day', 'Pax/day', 'Adj pax/day']].copy()
-        market_distance_df['Distance bucket'] = market_distance_df['NONSTOP_MILES'].apply(self._distance_bucket)
-        market_distance_bucket_df = market_distance_df[['NONSTOP_MILES', 'Distance bucket']].copy()
+        # A shard is handed the distance bucket totals over all shards' rows, rather than summing its own.
+        bucket_totals = self._shard_totals['Distance buckets'] if self._shard_totals is not None else None
+        df = _copy(existing_df)
+        market_distance_df = self._market_distance_frame(df)
+        market_distance_bucket_df = _copy(market_distance_df[['NONSTOP_MILES', 'Distance bucket']])
         market_distance_bucket_df.drop_duplicates(inplace=True)
         df = df.merge(market_distance_bucket_df, on='NONSTOP_MILES')
-        bucket_df = market_distance_df[['Distance bucket', 'NONSTOP_MILES', 'Revenue/day', 'Total revenue/day', 'Pax/day', 'Adj pax/day']].copy()
-        bucket_df['Pax miles'] = bucket_df['NONSTOP_MILES'] * bucket_df['Pax/day']
-        bucket_df['Adj pax miles'] = bucket_df['NONSTOP_MILES'] * bucket_df['Adj pax/day']
-        bucket_df.drop(columns=['NONSTOP_MILES', 'Pax/day', 'Adj pax/day'], axis=1, inplace=True)
-        bucket_df = bucket_df.groupby('Distance bucket', as_index=False).sum()
+        if bucket_totals is None:
+            bucket_df = self._distance_bucket_totals(market_distance_df)
+        else:
+            bucket_df = _copy(bucket_totals['Distance bucket'])
         bucket_df['Distance bucket yield'] = bucket_df['Revenue/day'] / bucket_df['Pax miles']
         bucket_df['Distance bucket total yield'] = bucket_df['Total revenue/day'] / bucket_df['Pax miles']
         bucket_df['Distance bucket density-adjusted total yield'] = bucket_df['Total revenue/day'] / bucket_df['Adj pax miles']
@@ -60,23 +212,14 @@ class DB1B:
         df['Market\'s distance total yield premium'] = df['Market total yield'] / df['Distance bucket total yield']
         df['Market\'s distance total flight yield premium'] = df['Market density-adjusted total yield'] / df['Distance bucket density-adjusted total yield']
 
-        metro_distance_df = df[['Origin metro', 'Destination metro', 'TICKET_CARRIER', 'NONSTOP_MILES', 'Revenue/day', 'Total revenue/day', 'Pax/day', 'Adj pax/day']].copy()
-        metro_distance_df['Pax miles'] = metro_distance_df['NONSTOP_MILES'] * metro_distance_df['Pax/day']
-        metro_distance_df['Adj pax miles'] = metro_distance_df['NONSTOP_MILES'] * metro_distance_df['Adj pax/day']
-        metro_distance_distance_df = metro_distance_df[['Origin metro', 'Destination metro', 'Pax miles', 'Adj pax miles', 'Pax/day', 'Adj pax/day']].copy()
-        metro_distance_distance_df = metro_distance_distance_df.groupby(['Origin metro', 'Destination metro'], as_index=False).sum()
-        metro_distance_distance_df['Metro distance'] = metro_distance_distance_df['Pax miles'] / metro_distance_distance_df['Pax/day']
-        metro_distance_distance_df.drop(columns=['Pax miles', 'Adj pax miles', 'Pax/day', 'Adj pax/day'], axis=1, inplace=True)
-        metro_distance_distance_df.drop_duplicates(inplace=True)
-        metro_distance_df = metro_distance_df.merge(metro_distance_distance_df, on=['Origin metro', 'Destination metro'])
-        metro_distance_df['Metro distance bucket'] = metro_distance_df['Metro distance'].apply(self._distance_bucket)
-        metro_distance_df.drop('Metro distance', axis=1, inplace=True)
-        metro_distance_df.drop_duplicates(inplace=True)
-        metro_distance_bucket_df = metro_distance_df[['Metro distance bucket', 'Origin metro', 'Destination metro']].copy()
+        metro_distance_df = self._metro_distance_frame(df)
+        metro_distance_bucket_df = _copy(metro_distance_df[['Metro distance bucket', 'Origin metro', 'Destination metro']])
         metro_distance_bucket_df.drop_duplicates(inplace=True)
         df = df.merge(metro_distance_bucket_df, on=['Origin metro', 'Destination metro'])
-        bucket_df = metro_distance_df[['Metro distance bucket', 'Pax miles', 'Adj pax miles', 'Revenue/day', 'Total revenue/day']].copy()
-        bucket_df = bucket_df.groupby('Metro distance bucket', as_index=False).sum()
+        if bucket_totals is None:
+            bucket_df = self._metro_distance_bucket_totals(metro_distance_df)
+        else:
+            bucket_df = _copy(bucket_totals['Metro distance bucket'])
         bucket_df['Metro distance bucket yield'] = bucket_df['Revenue/day'] / bucket_df['Pax miles']
         bucket_df['Metro distance bucket total yield'] = bucket_df['Total revenue/day'] / bucket_df['Pax miles']
         bucket_df['Metro distance bucket density-adjusted total yield'] = bucket_df['Total revenue/day'] / bucket_df['Adj pax miles']
@@ -91,13 +234,15 @@ class DB1B:
         df['Metro\'s distance total flight yield premium'] = df['Metro density-adjusted total yield'] / df['Metro distance bucket density-adjusted total yield']
 
         df['Adj pax miles'] = df['NONSTOP_MILES'] * df['Adj pax/day']
-        origin_df = df[['ORIGIN', 'TICKET_CARRIER', 'Distance bucket', 'Total revenue/day', 'Adj pax miles']].copy()
-        origin_df = origin_df.groupby(['ORIGIN', 'TICKET_CARRIER', 'Distance bucket'], as_index=False).sum()
+        origin_df = _copy(df[['ORIGIN', 'TICKET_CARRIER', 'Distance bucket', 'Total revenue/day', 'Adj pax miles']])
+        origin_df = origin_df.groupby(['ORIGIN', 'TICKET_CARRIER', 'Distance bucket'], as_index=False, observed=True).sum()
         origin_df['Carrier origin distance flight yield'] = origin_df['Total revenue/day'] / origin_df['Adj pax miles']
         origin_df.drop(columns=['Total revenue/day', 'Adj pax miles'], inplace=True)
 
-        bucket_df = df[['Distance bucket', 'Total revenue/day', 'Adj pax miles']].copy()
-        bucket_df = bucket_df.groupby(['Distance bucket'], as_index=False).sum()
+        if bucket_totals is None:
+            bucket_df = self._distance_flight_totals(df)
+        else:
+            bucket_df = _copy(bucket_totals['Distance flight'])
         bucket_df['Distance flight yield'] = bucket_df['Total revenue/day'] / bucket_df['Adj pax miles']
         bucket_df.drop(columns=['Total revenue/day', 'Adj pax miles'], inplace=True)
 
@@ -105,13 +250,13 @@ class DB1B:
         df = df.merge(bucket_df, on=['Distance bucket'])
         df['Carrier origin distance total flight yield premium'] = df['Carrier origin distance flight yield'] / df['Distance flight yield']
 
-        weighted_df = df[['ORIGIN', 'TICKET_CARRIER', 'Adj pax miles', 'Carrier origin distance total flight yield premium']].copy()
+        weighted_df = _copy(df[['ORIGIN', 'TICKET_CARRIER', 'Adj pax miles', 'Carrier origin distance total flight yield premium']])
         weighted_df['Yield premium miles'] = weighted_df['Adj pax miles'] * weighted_df['Carrier origin distance total flight yield premium']
-        partial_weighted_df = weighted_df.copy()
+        partial_weighted_df = _copy(weighted_df)
         df = df.merge(partial_weighted_df, on=['ORIGIN', 'TICKET_CARRIER', 'Adj pax miles', 'Carrier origin distance total flight yield premium'])
         df['Yield miles (1000)'] = df['Yield premium miles'] / 1000
         weighted_df.drop(columns=['Carrier origin distance total flight yield premium'], inplace=True)
-        weighted_df = weighted_df.groupby(['ORIGIN', 'TICKET_CARRIER']).sum()
+        weighted_df = weighted_df.groupby(['ORIGIN', 'TICKET_CARRIER'], observed=True).sum()
         weighted_df['Carrier origin average yield premium'] = weighted_df['Yield premium miles'] / weighted_df['Adj pax miles']
         weighted_df.drop(columns=['Yield premium miles', 'Adj pax miles'], inplace=True)
         df = df.merge(weighted_df, on=['ORIGIN', 'TICKET_CARRIER'])
@@ -120,230 +265,423 @@ class DB1B:
         return df
 
     @staticmethod
-    def _add_fare_per_pax(existing_df):
-        df = existing_df.copy()
-        df_metro_holder = df.copy()[['ORIGIN', 'DEST', 'Origin metro', 'Destination metro']].drop_duplicates()
-        df.drop(columns=['Origin metro', 'Destination metro'], axis=1, inplace=True)
-        df = df.groupby(['ORIGIN', 'DEST', 'NONSTOP_MILES', 'TICKET_CARRIER'], as_index=False).sum()
-        df = df.merge(df_metro_holder, on=['ORIGIN', 'DEST'])
-        df['Fare/pax'] = df['Revenue/day'] / df['Pax/day']
-        df['Total fare/pax'] = df['Total revenue/day'] / df['Pax/day']
-        df['Density-adjusted fare/pax'] = df['Total revenue/day'] / df['Adj pax/day']
-        df['Yield'] = df['Fare/pax'] / df['NONSTOP_MILES']
-        df['Total yield'] = df['Total fare/pax'] / df['NONSTOP_MILES']
-        df['Density-adjusted total yield'] = df['Density-adjusted fare/pax'] / df['NONSTOP_MILES']
-
-        df_market = df.copy()
-        df_market = df_market[['ORIGIN', 'DEST', 'Pax/day', 'Adj pax/day', 'Revenue/day', 'Total revenue/day']]
-        df_market = df_market.groupby(['ORIGIN', 'DEST'], as_index=False).sum()
-        df_market['Market fare/pax'] = df_market['Revenue/day'] / df_market['Pax/day']
-        df_market['Market total fare/pax'] = df_market['Total revenue/day'] / df_market['Pax/day']
-        df_market['Market density-adjusted fare/pax'] = df_market['Total revenue/day'] / df_market['Adj pax/day']
-        df_market.rename(columns={'Pax/day': 'Market pax/day', 'Adj pax/day': 'Market adj pax/day'}, inplace=True)
-        df_market.drop(columns=['Revenue/day', 'Total revenue/day'], axis=1, inplace=True)
-        df = df.merge(df_market, on=['ORIGIN', 'DEST'])
-        df['Market yield'] = df['Market fare/pax'] / df['NONSTOP_MILES']
-        df['Market total yield'] = df['Market total fare/pax'] / df['NONSTOP_MILES']
-        df['Market density-adjusted total yield'] = df['Market density-adjusted fare/pax'] / df['NONSTOP_MILES']
-        df['Market share'] = df['Pax/day'] / df['Market pax/day']
-        df['Market fare premium'] = df['Fare/pax'] / df['Market fare/pax']
-        df['Market total fare premium'] = df['Total fare/pax'] / df['Market total fare/pax']
-        df['Market total flight premium'] = df['Density-adjusted fare/pax'] / df['Market density-adjusted fare/pax']
-
-        df_metro = existing_df.copy()
-        df_metro = df_metro[['Origin metro', 'Destination metro', 'NONSTOP_MILES', 'TICKET_CARRIER', 'Pax/day', 'Adj pax/day', 'Revenue/day', 'Total revenue/day']]
-        df_metro['Pax miles'] = df_metro['Pax/day'] * df_metro['NONSTOP_MILES']
-        df_metro['Adj pax miles'] = df_metro['Adj pax/day'] * df_metro['NONSTOP_MILES']
-        df_metro_carrier = df_metro.copy().groupby(['Origin metro', 'Destination metro', 'TICKET_CARRIER'], as_index=False).sum()
-        df_metro_carrier['Carrier metro yield'] = df_metro_carrier['Revenue/day'] / df_metro_carrier['Pax miles']
-        df_metro_carrier['Carrier metro total yield'] = df_metro_carrier['Total revenue/day'] / df_metro_carrier['Pax miles']
-        df_metro_carrier['Carrier metro density-adjusted total yield'] = df_metro_carrier['Total revenue/day'] / df_metro_carrier['Adj pax miles']
-        df_metro_carrier.rename(columns={'Pax/day': 'Carrier metro pax/day', 'Adj pax/day': 'Carrier metro adj pax/day'}, inplace=True)
-        df_metro_carrier.drop(columns=['NONSTOP_MILES', 'Revenue/day', 'Total revenue/day', 'Pax miles', 'Adj pax miles'], axis=1, inplace=True)
-        df = df.merge(df_metro_carrier, on=['Origin metro', 'Destination metro', 'TICKET_CARRIER'])
-
-        df_metro.drop(columns=['TICKET_CARRIER', 'NONSTOP_MILES'], axis=1, inplace=True)
-        df_metro = df_metro.groupby(['Origin metro', 'Destination metro'], as_index=False).sum()
-        df_metro['Metro fare/pax'] = df_metro['Revenue/day'] / df_metro['Pax/day']
-        df_metro['Metro total fare/pax'] = df_metro['Total revenue/day'] / df_metro['Pax/day']
-        df_metro['Metro total adj fare/pax'] = df_metro['Total revenue/day'] / df_metro['Adj pax/day']
-        df_metro['Distance'] = df_metro['Pax miles'] / df_metro['Pax/day']
-        df_metro['Metro yield'] = df_metro['Metro fare/pax'] / df_metro['Distance']
-        df_metro['Metro total yield'] = df_metro['Metro total fare/pax'] / df_metro['Distance']
-        df_metro['Metro density-adjusted total yield'] = df_metro['Metro total adj fare/pax'] / df_metro['Distance']
-        df_metro.drop(columns=['Revenue/day', 'Total revenue/day', 'Distance', 'Pax miles', 'Adj pax miles'], axis=1, inplace=True)
-        df_metro.rename(columns={'Pax/day': 'Metro pax/day', 'Adj pax/day': 'Metro adj pax/day'}, inplace=True)
-        df = df.merge(df_metro, on=['Origin metro', 'Destination metro'])
-        df['Metro share'] = df['Carrier metro pax/day'] / df['Metro pax/day']
-        df['Metro fare premium'] = df['Carrier metro yield'] / df['Metro yield']
-        df['Metro total fare premium'] = df['Carrier metro total yield'] / df['Metro total yield']
-        df['Metro total flight premium'] = df['Carrier metro density-adjusted total yield'] / df['Metro density-adjusted total yield']
+    def _add_fare_per_pax(existing_df, group_sums=None):
+        # Rows are already consolidated by market, carrier, and distance; rows of group sums handed in are in that order.
+        if group_sums is None:
+            df = existing_df.sort_values(DB1B._MARKET_ORDER, ignore_index=True)
+            group_sums = _GroupSums(df)
+        else:
+            df = existing_df
+        columns = dict()
+        columns['Fare/pax'] = df['Revenue/day'] / df['Pax/day']
+        columns['Total fare/pax'] = df['Total revenue/day'] / df['Pax/day']
+        columns['Density-adjusted fare/pax'] = df['Total revenue/day'] / df['Adj pax/day']
+        columns['Yield'] = columns['Fare/pax'] / df['NONSTOP_MILES']
+        columns['Total yield'] = columns['Total fare/pax'] / df['NONSTOP_MILES']
+        columns['Density-adjusted total yield'] = columns['Density-adjusted fare/pax'] / df['NONSTOP_MILES']
 
-        return df
+        market = group_sums.sums(['ORIGIN', 'DEST'], {col: df[col] for col in ['Pax/day', 'Adj pax/day', 'Revenue/day', 'Total revenue/day']})
+        columns['Market pax/day'] = market['Pax/day']
+        columns['Market adj pax/day'] = market['Adj pax/day']
+        columns['Market fare/pax'] = market['Revenue/day'] / market['Pax/day']
+        columns['Market total fare/pax'] = market['Total revenue/day'] / market['Pax/day']
+        columns['Market density-adjusted fare/pax'] = market['Total revenue/day'] / market['Adj pax/day']
+        columns['Market yield'] = columns['Market fare/pax'] / df['NONSTOP_MILES']
+        columns['Market total yield'] = columns['Market total fare/pax'] / df['NONSTOP_MILES']
+        columns['Market density-adjusted total yield'] = columns['Market density-adjusted fare/pax'] / df['NONSTOP_MILES']
+        columns['Market share'] = df['Pax/day'] / columns['Market pax/day']
+        columns['Market fare premium'] = columns['Fare/pax'] / columns['Market fare/pax']
+        columns['Market total fare premium'] = columns['Total fare/pax'] / columns['Market total fare/pax']
+        columns['Market total flight premium'] = columns['Density-adjusted fare/pax'] / columns['Market density-adjusted fare/pax']
 
-    def _add_share(self, existing_df, airport_df, col):
-        airport_df['Airport'] = airport_df[col]
-        col = 'Origin' if col == 'ORIGIN' else 'Dest' if col == 'DEST' else 'Dest metro' if col == 'Destination metro' else 'Origin metro'
-        airport_df.drop(columns=['ORIGIN', 'DEST', 'Origin metro', 'Destination metro'], axis=1, inplace=True)
-        airport_df['NONSTOP_MILES'] = airport_df['NONSTOP_MILES'] * airport_df['Pax/day']
-        df = airport_df.groupby(['Airport', 'TICKET_CARRIER'], as_index=False).sum()
-        df[f'Carrier {col} pax/day'] = df['Pax/day']
-        df[f'Carrier {col} miles/pax'] = df['NONSTOP_MILES'] / df['Pax/day']
-        df[f'Carrier {col} fare/pax'] = df['Revenue/day'] / df['Pax/day']
-        df[f'Carrier {col} total fare/pax'] = df['Total revenue/day'] / df['Pax/day']
-        df[f'Carrier {col} total adj fare/pax'] = df['Total revenue/day'] / df['Adj pax/day']
-        df[f'Carrier {col} yield'] = df[f'Carrier {col} fare/pax'] / df[f'Carrier {col} miles/pax']
-        df[f'Carrier {col} total yield'] = df[f'Carrier {col} total fare/pax'] / df[f'Carrier {col} miles/pax']
-        df[f'Carrier {col} adj total yield'] = df[f'Carrier {col} total adj fare/pax'] / df[f'Carrier {col} miles/pax']
-        df.drop(f'Carrier {col} miles/pax', axis=1, inplace=True)
-        df = self._add_share_data_subset(df, df.copy(), col, col)
-        df = self._add_share_data_subset(df, df[~df['TICKET_CARRIER'].isin(self._configuration['ULCCs'])].copy(), col, f'{col} exc. ULCC')
-        df.drop(columns=['NONSTOP_MILES', 'Pax/day', 'Adj pax/day', 'Revenue/day', 'Total revenue/day'], inplace=True)
-        col_original_name = 'ORIGIN' if col == 'Origin' else 'DEST' if col == 'Dest' else 'Destination metro' if col == 'Dest metro' else 'Origin metro'
-        df.rename(columns={'Airport': col_original_name}, inplace=True)
-        df = existing_df.merge(df, on=[col_original_name, 'TICKET_CARRIER'])
-        return df
+        values = {
+            'Pax/day': df['Pax/day'],
+            'Adj pax/day': df['Adj pax/day'],
+            'Revenue/day': df['Revenue/day'],
+            'Total revenue/day': df['Total revenue/day'],
+            'Pax miles': df['Pax/day'] * df['NONSTOP_MILES'],
+            'Adj pax miles': df['Adj pax/day'] * df['NONSTOP_MILES'],
+        }
+        carrier_metro = group_sums.sums(['Origin metro', 'Destination metro', 'TICKET_CARRIER'], values)
+        columns['Carrier metro pax/day'] = carrier_metro['Pax/day']
+        columns['Carrier metro adj pax/day'] = carrier_metro['Adj pax/day']
+        columns['Carrier metro yield'] = carrier_metro['Revenue/day'] / carrier_metro['Pax miles']
+        columns['Carrier metro total yield'] = carrier_metro['Total revenue/day'] / carrier_metro['Pax miles']
+        columns['Carrier metro density-adjusted total yield'] = carrier_metro['Total revenue/day'] / carrier_metro['Adj pax miles']
 
-    @staticmethod
-    def _add_share_data_subset(df, df_market, col, output_col):
-        df_market_original = df_market.copy()
-        df_market = df_market[['Airport', 'NONSTOP_MILES', 'Revenue/day', 'Total revenue/day', 'Pax/day', 'Adj pax/day']]
-        df_market = df_market.groupby('Airport', as_index=False).sum()
-        df_market[f'{output_col} miles/pax'] = df_market['NONSTOP_MILES'] / df_market['Pax/day']
-        df_market[f'{output_col} fare/pax'] = df_market['Revenue/day'] / df_market['Pax/day']
-        df_market[f'{output_col} total fare/pax'] = df_market['Total revenue/day'] / df_market['Pax/day']
-        df_market[f'{output_col} adj total fare/pax'] = df_market['Total revenue/day'] / df_market['Adj pax/day']
-        df_market[f'{output_col} yield'] = df_market[f'{output_col} fare/pax'] / df_market[f'{output_col} miles/pax']
-        df_market[f'{output_col} total yield'] = df_market[f'{output_col} total fare/pax'] / df_market[f'{output_col} miles/pax']
-        df_market[f'{output_col} adj total yield'] = df_market[f'{output_col} adj total fare/pax'] / df_market[f'{output_col} miles/pax']
-        df_market.drop(columns=['NONSTOP_MILES', f'{output_col} miles/pax'], axis=1, inplace=True)
-        df_market.rename(columns={'Pax/day': f'{output_col} pax/day', 'Adj pax/day': f'{output_col} adj pax/day', 'Revenue/day': f'{output_col} revenue/day', 'Total revenue/day': f'{output_col} total revenue/day'}, inplace=True)
-        df_market_original = df_market_original[['Airport', 'TICKET_CARRIER']]
-        df_market = df_market_original.merge(df_market, on='Airport', how='left')
-        df = df.merge(df_market, on=['Airport', 'TICKET_CARRIER'], how='left')
-        df[f'{output_col} market share'] = df['Pax/day'] / df[f'{output_col} pax/day']
-        df[f'Carrier {output_col} yield premium'] = df[f'Carrier {col} yield'] / df[f'{output_col} yield']
-        df[f'Carrier {output_col} total yield premium'] = df[f'Carrier {col} total yield'] / df[f'{output_col} total yield']
-        df[f'Carrier {output_col} total flight yield premium'] = df[f'Carrier {col} adj total yield'] / df[f'{output_col} adj total yield']
-        df.drop(columns=[f'{output_col} adj pax/day', f'{output_col} revenue/day', f'{output_col} total revenue/day'], inplace=True)
-        df.fillna(0, inplace=True)
-        return df
+        metro = group_sums.sums(['Origin metro', 'Destination metro'], values)
+        columns['Metro pax/day'] = metro['Pax/day']
+        columns['Metro adj pax/day'] = metro['Adj pax/day']
+        columns['Metro fare/pax'] = metro['Revenue/day'] / metro['Pax/day']
+        columns['Metro total fare/pax'] = metro['Total revenue/day'] / metro['Pax/day']
+        columns['Metro total adj fare/pax'] = metro['Total revenue/day'] / metro['Adj pax/day']
+        distance = metro['Pax miles'] / metro['Pax/day']
+        columns['Metro yield'] = columns['Metro fare/pax'] / distance
+        columns['Metro total yield'] = columns['Metro total fare/pax'] / distance
+        columns['Metro density-adjusted total yield'] = columns['Metro total adj fare/pax'] / distance
+        columns['Metro share'] = columns['Carrier metro pax/day'] / columns['Metro pax/day']
+        columns['Metro fare premium'] = columns['Carrier metro yield'] / columns['Metro yield']
+        columns['Metro total fare premium'] = columns['Carrier metro total yield'] / columns['Metro total yield']
+        columns['Metro total flight premium'] = columns['Carrier metro density-adjusted total yield'] / columns['Metro density-adjusted total yield']
 
-    def _add_shares(self, existing_df, data_df):
-        df = self._add_share(existing_df, data_df.copy(), 'ORIGIN')
-        df = self._add_share(df, data_df.copy(), 'DEST')
-        df = self._add_share(df, data_df.copy(), 'Origin metro')
-        df = self._add_share(df, data_df.copy(), 'Destination metro')
-        return df
+        return pd.concat([df, pd.DataFrame(columns)], axis=1)
+
+    def _add_fare_quantiles(self, df):
+        # Each row takes the quantiles of its carrier's fares in its market and of all fares in its metro market.
+        sketch = self._categorize_keys(merge_sketches(self._fare_sketches, self._FARE_SKETCH_KEYS))
+        metro_sketch = sketch.drop(columns=self._FARE_SKETCH_KEYS).assign(**{
+            'Origin metro': self._metros(sketch['ORIGIN']),
+            'Destination metro': self._metros(sketch['DEST']),
+        })
+        metro_sketch = merge_sketches([metro_sketch], ['Origin metro', 'Destination metro'])
+
+        columns = dict()
+        for prefix, group_sketch, keys, output_keys in [
+            ('Carrier', sketch, self._FARE_SKETCH_KEYS, ['Origin', 'Destination', 'Carrier']),
+            ('Metro', metro_sketch, ['Origin metro', 'Destination metro'], ['Origin metro', 'Destination metro']),
+        ]:
+            quantiles = sketch_quantiles(group_sketch, keys)
+            # Looked up by value, since the output's keys and the sketch's keys are categorized differently
+            quantiles = quantiles.set_index(pd.MultiIndex.from_arrays([quantiles[col].astype(str) for col in keys]))
+            rows = pd.MultiIndex.from_arrays([df[col].astype(str) for col in output_keys])
+            for col, values in quantiles.drop(columns=keys).reindex(rows).items():
+                columns[f'{prefix} {col}'] = values.to_numpy()
+        return pd.concat([df, pd.DataFrame(columns, index=df.index)], axis=1)
+
+    def _add_share(self, df, group_sums, col):
+        col_name = 'Origin' if col == 'ORIGIN' else 'Dest' if col == 'DEST' else 'Dest metro' if col == 'Destination metro' else 'Origin metro'
+        columns = dict()
+        carrier = group_sums.sums([col, 'TICKET_CARRIER'], self._share_values(df))
+        carrier_miles_per_pax = carrier['Pax miles'] / carrier['Pax/day']
+        columns[f'Carrier {col_name} pax/day'] = carrier['Pax/day']
+        columns[f'Carrier {col_name} fare/pax'] = carrier['Revenue/day'] / carrier['Pax/day']
+        columns[f'Carrier {col_name} total fare/pax'] = carrier['Total revenue/day'] / carrier['Pax/day']
+        columns[f'Carrier {col_name} total adj fare/pax'] = carrier['Total revenue/day'] / carrier['Adj pax/day']
+        columns[f'Carrier {col_name} yield'] = columns[f'Carrier {col_name} fare/pax'] / carrier_miles_per_pax
+        columns[f'Carrier {col_name} total yield'] = columns[f'Carrier {col_name} total fare/pax'] / carrier_miles_per_pax
+        columns[f'Carrier {col_name} adj total yield'] = columns[f'Carrier {col_name} total adj fare/pax'] / carrier_miles_per_pax
+        self._add_share_data_subset(df, group_sums, columns, col, col_name, col_name)
+        self._add_share_data_subset(df, group_sums, columns, col, col_name, f'{col_name} exc. ULCC',
+                                    ~df['TICKET_CARRIER'].isin(self._configuration['ULCCs']))
+        # Shares are zero where they are undefined, which includes the exc. ULCC shares of ULCCs.
+        return pd.DataFrame(columns).fillna(0)
+
+    def _add_share_data_subset(self, df, group_sums, columns, col, col_name, output_col, rows=None):
+        airport = group_sums.sums([col], self._share_values(df), rows)
+        miles_per_pax = airport['Pax miles'] / airport['Pax/day']
+        subset = dict()
+        subset[f'{output_col} pax/day'] = airport['Pax/day']
+        subset[f'{output_col} fare/pax'] = airport['Revenue/day'] / airport['Pax/day']
+        subset[f'{output_col} total fare/pax'] = airport['Total revenue/day'] / airport['Pax/day']
+        subset[f'{output_col} adj total fare/pax'] = airport['Total revenue/day'] / airport['Adj pax/day']
+        subset[f'{output_col} yield'] = subset[f'{output_col} fare/pax'] / miles_per_pax
+        subset[f'{output_col} total yield'] = subset[f'{output_col} total fare/pax'] / miles_per_pax
+        subset[f'{output_col} adj total yield'] = subset[f'{output_col} adj total fare/pax'] / miles_per_pax
+        subset[f'{output_col} market share'] = columns[f'Carrier {col_name} pax/day'] / subset[f'{output_col} pax/day']
+        subset[f'Carrier {output_col} yield premium'] = columns[f'Carrier {col_name} yield'] / subset[f'{output_col} yield']
+        subset[f'Carrier {output_col} total yield premium'] = columns[f'Carrier {col_name} total yield'] / subset[f'{output_col} total yield']
+        subset[f'Carrier {output_col} total flight yield premium'] = columns[f'Carrier {col_name} adj total yield'] / subset[f'{output_col} adj total yield']
+        if rows is not None:
+            # Rows outside the subset have no values for it
+            subset = {column: values.where(rows) for column, values in subset.items()}
+        columns.update(subset)
+
+    def _add_shares(self, df, group_sums=None):
+        if group_sums is None and self._shard_totals is None:
+            group_sums = _GroupSums(df)
+        elif group_sums is None:
+            group_sums = _ShardGroupSums(df, self._shard_totals['Shares'])
+        shares = [self._add_share(df, group_sums, col) for col in ['ORIGIN', 'DEST', 'Origin metro', 'Destination metro']]
+        return pd.concat([df] + shares, axis=1)
 
     def _add_to_analysis_length(self, year, quarter):
         self._analysis_length += self._timeframe_length(year, quarter)
+        self._quarters.append((year, quarter))
+
+    @staticmethod
+    def _categorize_keys(df):
+        # Origins and destinations share their categories, as do the origin and destination metros derived from them
+        airports = pd.Index(df['ORIGIN'].dropna().unique()).union(pd.Index(df['DEST'].dropna().unique()))
+        return df.astype({'ORIGIN': pd.CategoricalDtype(airports), 'DEST': pd.CategoricalDtype(airports), 'TICKET_CARRIER': 'category'})
+
+    def _collect_flow_validations(self):
+        reports = []
+        for input_path, year, quarter, validation in self._flow_validations:
+            report = validation.result()
+            report.insert(0, 'QUARTER', quarter)
+            report.insert(0, 'YEAR', year)
+            report.insert(0, 'File', input_path)
+            reports.append(report)
+        self._flow_validations = []
+        if self._flow_validator is not None:
+            # Shut down rather than kept, so that the object can be handed to worker processes again.
+            self._flow_validator.shutdown()
+            self._flow_validator = None
+        return pd.concat(reports, ignore_index=True) if reports else None
+
+    def _compact(self, df):
+        # In low-memory mode, stores derived values in single precision, other than those later stages depend on
+        if not self._low_memory:
+            return df
+        # Built as a new frame rather than by astype, which would leave each converted column in a block of its own
+        return pd.DataFrame({col: values.astype('float32') if values.dtype == 'float64' and col not in self._LOW_MEMORY_EXACT_COLUMNS else values
+                             for col, values in df.items()}, index=df.index)
+
+    def _compile_configuration(self):
+        self._configuration['Airport metros'] = dict()
+        for metro, airports in self._configuration['Metro areas'].items():
+            for airport in airports:
+                self._configuration['Airport metros'][airport] = metro
 
-    def _ancillary_revenue(self, carrier):
-        return self._configuration['Ancillary revenue per passenger'].get(carrier, self._configuration['Ancillary revenue per passenger']['Default'])
+        # Lookup tables that are applied to each category of a categorical column rather than to each row
+        self._airport_metros = pd.Series(self._configuration['Airport metros'], dtype=object)
+        self._ancillary_revenues = pd.Series(self._configuration['Ancillary revenue per passenger'], dtype='float64')
+        self._density_bonuses = 1 + pd.Series(self._configuration['Extra seats'], dtype='float64')
+
+    def _configuration_changed(self, other, sections):
+        return any(self._configuration.get(section) != other._configuration.get(section) for section in sections)
 
     @staticmethod
     def _consolidate_data_file(df):
-        return df.groupby(['ORIGIN', 'DEST', 'TICKET_CARRIER', 'NONSTOP_MILES'], as_index=False).sum()
-
-    def _density_bonus(self, carrier):
-        return 1 + self._configuration['Extra seats'].get(carrier, self._configuration['Extra seats']['Default'])
+        return df.groupby(['ORIGIN', 'DEST', 'TICKET_CARRIER', 'NONSTOP_MILES'], as_index=False, observed=True).sum()
 
     def _distance_bucket(self, distance):
-        return self._configuration['Distance bucket size'] * self._divide_and_drop_remainder(distance, self._configuration['Distance bucket size']) + self._configuration['Distance bucket size'] / 2
+        # Works on whole columns of distances as well as on single distances
+        return self._configuration['Distance bucket size'] * (distance // self._configuration['Distance bucket size']) + self._configuration['Distance bucket size'] / 2
 
     @staticmethod
-    def _divide_and_drop_remainder(dividend, divisor):
-        remainder = dividend % divisor
-        return (dividend - remainder) / divisor
+    def _distance_bucket_totals(market_distance_df):
+        bucket_df = _copy(market_distance_df[['Distance bucket', 'NONSTOP_MILES', 'Revenue/day', 'Total revenue/day', 'Pax/day', 'Adj pax/day']])
+        bucket_df['Pax miles'] = bucket_df['NONSTOP_MILES'] * bucket_df['Pax/day']
+        bucket_df['Adj pax miles'] = bucket_df['NONSTOP_MILES'] * bucket_df['Adj pax/day']
+        bucket_df.drop(columns=['NONSTOP_MILES', 'Pax/day', 'Adj pax/day'], axis=1, inplace=True)
+        return bucket_df.groupby('Distance bucket', as_index=False).sum()
 
-    def _filter_at_end(self, df):
-        share_filter = self._configuration['Filters at end'].get('Metro market share', 0)
-        share_filter = share_filter if share_filter < 1 else share_filter / 100.0
-        df = df[df['Metro share'] >= share_filter]
-        df = df[df['Pax/day'] >= self._configuration['Filters at end'].get('Market carrier pax/day', 0)]
-        df = df[df['Metro pax/day'] >= self._configuration['Filters at end'].get('Metro pax/day', 0)]
-        df.drop(columns=['Revenue/day', 'Total revenue/day'], axis=1, inplace=True)
+    @staticmethod
+    def _distance_flight_totals(df):
+        bucket_df = _copy(df[['Distance bucket', 'Total revenue/day', 'Adj pax miles']])
+        return bucket_df.groupby(['Distance bucket'], as_index=False).sum()
+
+    def _enrich_fresh_data(self):
+        if self._shards is not None:
+            return self._enrich_sharded()
+
+        if self._shared_enrichment:
+            with self._profiler.stage('_enrich_shared', self._full_df.shape) as stage:
+                unfiltered_df, filtered_df = self._enrich_shared()
+                stage.output(unfiltered_df.shape)
+        else:
+            # Each side is cut down to the columns it contributes as soon as it is enriched, rather than at the merge.
+            unfiltered_df = self._unfiltered_output_columns(self._enrich_variant(self._full_df, 'unfiltered'))
+            if self._low_memory:
+                self._full_df = None
+            filtered_df = self._filtered_output_columns(self._enrich_variant(self._filtered_df, 'filtered'))
+        if self._low_memory:
+            # Neither is needed once enriched, so they are freed before the merge rather than kept to the end of the run.
+            self._full_df = self._filtered_df = None
+
+        with self._profiler.stage('Merge', unfiltered_df.shape) as stage:
+            merged_df = self._merge_enrichments(unfiltered_df, filtered_df)
+            merged_df = self._reorder_output_columns(merged_df)
+            stage.output(merged_df.shape)
+        return merged_df
+
+    def _enrich_memoized(self):
+        # Stages are evaluated from the output back, so the stages before a cached one are not evaluated at all.
+        stages = self._pipeline_stages()
+        keys = dict()
+        for name, (inputs, configuration, _) in stages.items():
+            keys[name] = StageCache.stage_key(name, {input_name: keys[input_name] for input_name in inputs}, configuration)
+        outputs = dict()
+        outcomes = dict()
+
+        def evaluate(name, reason=None):
+            if name in outputs:
+                return outputs[name]
+            inputs, configuration, compute = stages[name]
+            input_keys = {input_name: keys[input_name] for input_name in inputs}
+            cached = self._stage_cache.get(keys[name]) if reason is None else None
+            if cached is not None:
+                outputs[name], metadata = cached
+                # Later stages need the number of days the data files cover, which reading them would have counted.
+                for year, quarter in metadata.get('Quarters', []):
+                    self._add_to_analysis_length(year, quarter)
+                outcomes[name] = 'reused'
+                return outputs[name]
+
+            outcomes[name] = f'recomputed, since {reason or self._stage_cache.explain(name, input_keys, configuration)}'
+            input_dfs = [evaluate(input_name) for input_name in inputs]
+            with self._profiler.stage(name, input_dfs[0].shape if input_dfs else None) as stage:
+                outputs[name] = compute(*input_dfs)
+                stage.output(outputs[name].shape)
+            metadata = {'Stage': name, 'Inputs': input_keys, 'Configuration': configuration}
+            if not inputs:
+                metadata['Quarters'] = self._quarters
+            self._stage_cache.put(keys[name], outputs[name], metadata)
+            return outputs[name]
+
+        validation_configuration = dict(stages['_get_consolidated_data'][1], **{
+            'Passenger flow validation': self._configuration['Passenger flow validation'],
+        })
+        validation_key = StageCache.stage_key('Flow validation', {}, validation_configuration)
+        cached_validation = self._stage_cache.get(validation_key)
+        if cached_validation is None:
+            outcomes['Flow validation'] = \
+                f'recomputed, since {self._stage_cache.explain("Flow validation", {}, validation_configuration)}'
+            evaluate('_get_consolidated_data', reason='the data files\' flow validation is not cached')
+        else:
+            # The data files are still read if a later stage or the fare sketch is not cached, but not validated again.
+            inputs, configuration, _ = stages['_get_consolidated_data']
+            stages['_get_consolidated_data'] = (inputs, configuration, lambda: self._get_consolidated_data(validate_flows=False))
+        # The data files' fares are sketched as they are read, too.
+        sketch_configuration = stages['_get_consolidated_data'][1]
+        sketch_key = StageCache.stage_key('Fare sketch', {}, sketch_configuration)
+        cached_sketch = self._stage_cache.get(sketch_key) if self._fare_quantiles else None
+        if self._fare_quantiles and cached_sketch is None:
+            outcomes['Fare sketch'] = f'recomputed, since {self._stage_cache.explain("Fare sketch", {}, sketch_configuration)}'
+            evaluate('_get_consolidated_data', reason='the data files\' fare sketch is not cached')
+        merged_df = evaluate(list(stages)[-1])
+
+        if cached_validation is not None:
+            outcomes['Flow validation'] = 'reused'
+            self._report_flow_validations(cached_validation[0])
+        else:
+            # Cached before it is reported, so that a strict run that fails on it fails from the cache when rerun
+            report = self._collect_flow_validations()
+            self._stage_cache.put(validation_key, report, {'Stage': 'Flow validation', 'Inputs': {},
+                                                           'Configuration': validation_configuration})
+            self._report_flow_validations(report)
+        if cached_sketch is not None:
+            outcomes['Fare sketch'] = 'reused'
+            self._fare_sketches = [cached_sketch[0]]
+        elif self._fare_quantiles:
+            self._fare_sketches = [merge_sketches(self._fare_sketches, self._FARE_SKETCH_KEYS)]
+            self._stage_cache.put(sketch_key, self._fare_sketches[0], {'Stage': 'Fare sketch', 'Inputs': {},
+                                                                       'Configuration': sketch_configuration})
+        if self._explain_cache:
+            for name in ['Flow validation'] + (['Fare sketch'] if self._fare_quantiles else []) + list(stages):
+                print(f'{name}: {outcomes.get(name, "skipped, since a later stage was reused")}')
+        return merged_df
+
+    def _enrich_sharded(self):
+        # Totals spanning shards are summed here, over all rows in the unsharded order, so that they round the same way.
+        variants = dict()
+        for variant, df in [('unfiltered', self._full_df), ('filtered', self._filtered_df)]:
+            with self._profiler.stage(f'Shard totals ({variant})', df.shape):
+                df = df.sort_values(self._MARKET_ORDER, ignore_index=True)
+                variants[variant] = (df, self._shard_share_totals(df), self._shard_distance_bucket_totals(df))
+        shard_of_metro = self._shard_metros(self._full_df['Origin metro'])
+
+        shards = []
+        for shard in range(shard_of_metro.max() + 1):
+            shards.append(dict())
+            for variant, (df, share_totals, distance_bucket_totals) in variants.items():
+                rows = np.flatnonzero(shard_of_metro[df['Origin metro'].cat.codes.to_numpy()] == shard)
+                shard_share_totals = {key: (codes[rows], totals) for key, (codes, totals) in share_totals.items()}
+                shards[-1][f'{variant}, shard {shard + 1}'] = (df.iloc[rows], shard_share_totals, distance_bucket_totals)
+
+        # Workers are handed a copy that holds none of the data, which each shard brings with it.
+        db1b = copy.copy(self)
+        db1b._full_df = db1b._filtered_df = None
+        db1b._flow_validator, db1b._flow_validations = None, []
+        workers = min(self._workers or os.cpu_count() or 1, len(shards))
+        with self._profiler.stage('Enrich shards', self._full_df.shape) as stage:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_enrich_shard, [db1b] * len(shards), shards))
+            for _, profile_records in results:
+                self._profiler.add(profile_records)
+            stage.output((sum(len(df) for df, _ in results), None))
+        if self._low_memory:
+            self._full_df = self._filtered_df = None
+
+        with self._profiler.stage('Merge', (sum(len(df) for df, _ in results), None)) as stage:
+            # The copies _add_distance_premiums makes of a row are adjacent within a shard, so a stable sort keeps them.
+            merged_df = pd.concat([df for df, _ in results], ignore_index=True)
+            merged_df = merged_df.sort_values(self._MARKET_ORDER, kind='stable', ignore_index=True)
+            merged_df = self._reorder_output_columns(merged_df)
+            stage.output(merged_df.shape)
+        return merged_df
+
+    def _enrich_shared(self):
+        # The filtered data is rows of the unfiltered data, so the groups of both are coded once, on the unfiltered data.
+        full_df = self._full_df.sort_values(self._MARKET_ORDER, ignore_index=True)
+        keys = ['ORIGIN', 'DEST', 'TICKET_CARRIER', 'NONSTOP_MILES']
+        filtered = pd.MultiIndex.from_frame(full_df[keys]).isin(pd.MultiIndex.from_frame(self._filtered_df[keys]))
+        group_sums = _GroupSums(full_df)
+        unfiltered_df = self._enrich_variant(full_df, 'unfiltered', group_sums)
+        filtered_df = self._enrich_variant(full_df[filtered].reset_index(drop=True), 'filtered', group_sums.filtered(filtered))
+        return self._unfiltered_output_columns(unfiltered_df), self._filtered_output_columns(filtered_df)
+
+    def _enrich_variant(self, df, variant, group_sums=None, filter_at_end=True):
+        df = _copy(df)
+        steps = [(self._add_fare_per_pax, [group_sums]), (self._add_shares, [group_sums]), (self._add_distance_premiums, [])]
+        for step, args in steps + ([(self._filter_at_end, [])] if filter_at_end else []):
+            with self._profiler.stage(f'{step.__name__} ({variant})', df.shape) as stage:
+                df = self._compact(step(df, *args))
+                stage.output(df.shape)
         return df
 
+    def _filter_at_end(self, df):
+        df = df[self._passes_filters_at_end(df['Metro share'], df['Pax/day'], df['Metro pax/day'])]
+        return df.drop(columns=['Revenue/day', 'Total revenue/day'], axis=1)
+
     def _filter_at_beginning(self, df):
         return df[~df['TICKET_CARRIER'].isin(self._configuration['Filters at beginning']['Invalid carriers'])]
 
     def _filter_for_share(self, df):
-        df = df[df['Pax/day'] >= self._configuration['Filters at beginning'].get('Market carrier pax/day', 0)]
-
-        new_df_len = len(df)
-        df_len = new_df_len + 1
-
-        while df_len > new_df_len:
-            df_market = df.copy()[['ORIGIN', 'DEST', 'Pax/day']]
-            df_market = df_market.groupby(['ORIGIN', 'DEST'], as_index=False).sum()
-            df_market.rename(columns={'Pax/day': 'Market pax/day'}, inplace=True)
-            df = df.merge(df_market, on=['ORIGIN', 'DEST'])
-            df = df[df['Market pax/day'] >= self._configuration['Filters at beginning'].get('Market pax/day', 0)]
-            df.drop(columns=['Market pax/day'], axis=1, inplace=True)
-
-            df_metro = df.copy()[['Origin metro', 'Destination metro', 'Pax/day']]
-            df_metro_carrier = df_metro.copy().groupby(['Origin metro', 'Destination metro'], as_index=False).sum()
-            df_metro_carrier.rename(columns={'Pax/day': 'Metro pax/day'}, inplace=True)
-            df = df.merge(df_metro_carrier, on=['Origin metro', 'Destination metro'])
-            df = df[df['Metro pax/day'] >= self._configuration['Filters at beginning'].get('Metro pax/day', 0)]
-            df.drop(columns=['Metro pax/day'], axis=1, inplace=True)
-
-            df_market = df.copy()[['ORIGIN', 'DEST', 'Pax/day']]
-            df_market = df_market.groupby(['ORIGIN', 'DEST'], as_index=False).sum()
-            df_market.rename(columns={'Pax/day': 'Market pax/day'}, inplace=True)
-            df = df.merge(df_market, on=['ORIGIN', 'DEST'])
-            df['Market share'] = df['Pax/day'] / df['Market pax/day']
-            df.drop(columns=['Market pax/day'], axis=1, inplace=True)
-
-            df_metro = df.copy()[['Origin metro', 'Destination metro', 'TICKET_CARRIER', 'Pax/day']]
-            df_metro_carrier = df_metro.copy().groupby(['Origin metro', 'Destination metro', 'TICKET_CARRIER'], as_index=False).sum()
-            df_metro_carrier.rename(columns={'Pax/day': 'Carrier metro pax/day'}, inplace=True)
-            df = df.merge(df_metro_carrier, on=['Origin metro', 'Destination metro', 'TICKET_CARRIER'])
-
-            df_metro.drop(columns=['TICKET_CARRIER'], axis=1, inplace=True)
-            df_metro = df_metro.groupby(['Origin metro', 'Destination metro'], as_index=False).sum()
-            df_metro.rename(columns={'Pax/day': 'Metro pax/day'}, inplace=True)
-            df = df.merge(df_metro, on=['Origin metro', 'Destination metro'])
-            df['Metro share'] = df['Carrier metro pax/day'] / df['Metro pax/day']
-            df.drop(columns=['Metro pax/day', 'Carrier metro pax/day'], axis=1, inplace=True)
-
-            df = df[((df['Market share'] >= self._configuration['Filters at beginning'].get('Market share', 0)) |
-                    (df['Pax/day'] > self._configuration['Filters at beginning']['Do not filter if'].get('Market carrier pax/day', 10000)))]
-            df = df[((df['Metro share'] >= self._configuration['Filters at beginning'].get('Metro share', 0)) |
-                     (df['Pax/day'] > self._configuration['Filters at beginning']['Do not filter if'].get('Market carrier pax/day', 10000)))]
-            df.drop(columns=['Metro share', 'Market share'], axis=1, inplace=True)
-
-            df_len = new_df_len
-            new_df_len = len(df)
+        return df[self._share_filter_mask(df)].reset_index(drop=True)
 
-        return df
+    def _filtered_output_columns(self, df):
+        # The yield and premium columns, which the output takes from the filtered data
+        return df[[col for col in df.columns if col in self._MERGE_COLUMNS or 'yield' in col or 'premium' in col]]
+
+    def _finish_flow_validation(self):
+        report = self._collect_flow_validations()
+        if report is not None:
+            self._report_flow_validations(report)
+        return report
+
+    def _get_consolidated_data(self, validate_flows=True, input_paths=None):
+        input_paths = self._input_paths if input_paths is None else input_paths
+        if self._parallel:
+            data_files = self._get_data_files_in_parallel(input_paths)
+        else:
+            data_files = [self._get_data_file(df) for df in input_paths]
+        if validate_flows:
+            for input_path, (year, quarter), df in zip(input_paths, self._quarters[-len(data_files):], data_files):
+                self._validate_flows_in_background(input_path, df, year, quarter)
+        df = pd.concat(data_files)
+        df = self._categorize_keys(df)
+        return self._consolidate_data_file(df)
 
     def _get_data_file(self, input_path):
-        df = pd.read_csv(input_path)
-        df = df[['YEAR', 'QUARTER', 'ORIGIN', 'DEST', 'TICKET_CARRIER', 'PASSENGERS', 'MARKET_FARE', 'NONSTOP_MILES']]
-        self._add_to_analysis_length(df['YEAR'][0], df['QUARTER'][0])
-        df = self._filter_at_beginning(df)
-        self._validate_data_file(df)
-        df = df[['ORIGIN', 'DEST', 'TICKET_CARRIER', 'PASSENGERS', 'MARKET_FARE', 'NONSTOP_MILES']]
-        df = self._consolidate_data_file(df)
+        with self._profiler.stage(f'Read {input_path}') as stage:
+            df = self._load_data_file(input_path)
+            stage.output(df.shape)
         return df
 
+    def _get_data_files_in_parallel(self, input_paths):
+        workers = min(self._workers or os.cpu_count() or 1, len(input_paths))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_ingest_data_file, [self] * len(input_paths), input_paths))
+        for _, quarters, fare_sketches, profile_records in results:
+            for year, quarter in quarters:
+                self._add_to_analysis_length(year, quarter)
+            self._fare_sketches.extend(fare_sketches)
+            self._profiler.add(profile_records)
+        return [df for df, _, _, _ in results]
+
     def _get_fresh_data(self):
-        self._full_df = pd.concat([self._get_data_file(df) for df in self._input_paths])
-        self._full_df = self._consolidate_data_file(self._full_df)
-        self._full_df['Pax/day'] = self._full_df['PASSENGERS'] / (0.1 * self._analysis_length)  # Data is a 10% sample
-        self._full_df['Adj pax/day'] = self._full_df['Pax/day'] / self._full_df['TICKET_CARRIER'].apply(self._density_bonus)
-        self._full_df['Revenue/day'] = self._full_df['MARKET_FARE'] / (0.1 * self._analysis_length)
-        self._full_df['Ancillary revenue'] = self._full_df['TICKET_CARRIER'].apply(self._ancillary_revenue)
-        self._full_df['Total revenue/day'] = self._full_df['Revenue/day'] + self._full_df['Ancillary revenue'] * self._full_df['Pax/day']
-        self._full_df.drop('PASSENGERS', axis=1, inplace=True)
-        self._full_df.drop('MARKET_FARE', axis=1, inplace=True)
-        self._full_df.drop('Ancillary revenue', axis=1, inplace=True)
-        self._full_df['Origin metro'] = self._full_df['ORIGIN'].apply(self._metro)
-        self._full_df['Destination metro'] = self._full_df['DEST'].apply(self._metro)
-        self._filtered_df = self._filter_for_share(self._full_df.copy())
+        self._full_df = self._add_daily_values(self._get_consolidated_data())
+        with self._profiler.stage('_filter_for_share', self._full_df.shape) as stage:
+            self._filtered_df = self._filter_for_share(self._full_df)
+            stage.output(self._filtered_df.shape)
+
+    def _ingestion_configuration(self):
+        # Flows are validated from the consolidated data on every run, so their thresholds do not affect it.
+        return {
+            'Invalid carriers': self._configuration['Filters at beginning']['Invalid carriers'],
+        }
 
     def _load_configuration(self):
         try:
@@ -352,18 +690,169 @@ class DB1B:
         except FileNotFoundError:
             with open('./configuration.example.json') as f:
                 self._configuration = json.load(f)
+        self._compile_configuration()
 
-        self._configuration['Airport metros'] = dict()
-        for metro, airports in self._configuration['Metro areas'].items():
-            for airport in airports:
-                self._configuration['Airport metros'][airport] = metro
+    def _load_data_file(self, input_path):
+        if self._cache is not None:
+            key = self._cache.key(input_path, self._ingestion_configuration())
+            # The fare sketch is cached alongside the consolidated data, under a key derived from the data's.
+            sketch_key = StageCache.stage_key('Data file fare sketch', {'Data file': key}, {})
+            cached = self._cache.get(key)
+            cached_sketch = self._cache.get(sketch_key) if self._fare_quantiles and cached is not None else None
+            if cached is not None and (cached_sketch is not None or not self._fare_quantiles):
+                df, metadata = cached
+                self._add_to_analysis_length(metadata['YEAR'], metadata['QUARTER'])
+                if cached_sketch is not None:
+                    self._fare_sketches.append(cached_sketch[0])
+                return df
+
+        if self._chunk_size is not None:
+            df, sketch, year, quarter = self._read_data_file_in_chunks(input_path)
+        else:
+            df, sketch, year, quarter = self._read_data_file(input_path)
+        self._add_to_analysis_length(year, quarter)
+        if sketch is not None:
+            self._fare_sketches.append(sketch)
+
+        if self._cache is not None:
+            metadata = {
+                'Input path': os.path.abspath(input_path),
+                'YEAR': year,
+                'QUARTER': quarter,
+            }
+            self._cache.put(key, df, metadata)
+            if sketch is not None:
+                self._cache.put(sketch_key, sketch, dict(metadata, Stage='Data file fare sketch'))
+        return df
 
-    def _metro(self, airport):
-        return self._configuration['Airport metros'].get(airport, airport)
+    @staticmethod
+    def _lookup_categories(column, table):
+        values = table.reindex(column.cat.categories).fillna(table['Default']).to_numpy()
+        # Missing values are coded -1, which picks up the default appended to the end
+        return np.append(values, table['Default'])[column.cat.codes.to_numpy()]
+
+    def _market_distance_frame(self, df):
+        market_distance_df = _copy(df[['ORIGIN', 'DEST', 'TICKET_CARRIER', 'NONSTOP_MILES', 'Revenue/day', 'Total revenue/day', 'Pax/day', 'Adj pax/day']])
+        market_distance_df['Distance bucket'] = self._distance_bucket(market_distance_df['NONSTOP_MILES'])
+        return market_distance_df
+
+    def _merge_enrichments(self, unfiltered_df, filtered_df):
+        unfiltered_df = self._unfiltered_output_columns(unfiltered_df)
+        filtered_df = self._filtered_output_columns(filtered_df)
+        return unfiltered_df.merge(filtered_df, how='left', on=self._MERGE_COLUMNS)
+
+    def _metro_distance_frame(self, df):
+        metro_distance_df = _copy(df[['Origin metro', 'Destination metro', 'TICKET_CARRIER', 'NONSTOP_MILES', 'Revenue/day', 'Total revenue/day', 'Pax/day', 'Adj pax/day']])
+        metro_distance_df['Pax miles'] = metro_distance_df['NONSTOP_MILES'] * metro_distance_df['Pax/day']
+        metro_distance_df['Adj pax miles'] = metro_distance_df['NONSTOP_MILES'] * metro_distance_df['Adj pax/day']
+        metro_distance_distance_df = _copy(metro_distance_df[['Origin metro', 'Destination metro', 'Pax miles', 'Adj pax miles', 'Pax/day', 'Adj pax/day']])
+        metro_distance_distance_df = metro_distance_distance_df.groupby(['Origin metro', 'Destination metro'], as_index=False, observed=True).sum()
+        metro_distance_distance_df['Metro distance'] = metro_distance_distance_df['Pax miles'] / metro_distance_distance_df['Pax/day']
+        metro_distance_distance_df.drop(columns=['Pax miles', 'Adj pax miles', 'Pax/day', 'Adj pax/day'], axis=1, inplace=True)
+        metro_distance_distance_df.drop_duplicates(inplace=True)
+        metro_distance_df = metro_distance_df.merge(metro_distance_distance_df, on=['Origin metro', 'Destination metro'])
+        metro_distance_df['Metro distance bucket'] = self._distance_bucket(metro_distance_df['Metro distance'])
+        metro_distance_df.drop('Metro distance', axis=1, inplace=True)
+        metro_distance_df.drop_duplicates(inplace=True)
+        return metro_distance_df
+
+    @staticmethod
+    def _metro_distance_bucket_totals(metro_distance_df):
+        bucket_df = _copy(metro_distance_df[['Metro distance bucket', 'Pax miles', 'Adj pax miles', 'Revenue/day', 'Total revenue/day']])
+        return bucket_df.groupby('Metro distance bucket', as_index=False).sum()
+
+    def _metros(self, airports):
+        categories = airports.cat.categories
+        metros = self._airport_metros.reindex(categories).fillna(pd.Series(categories, index=categories))
+        metro_codes, metro_categories = pd.factorize(metros.to_numpy(), sort=True)
+        codes = airports.cat.codes.to_numpy()
+        return pd.Categorical.from_codes(np.where(codes >= 0, metro_codes[codes], -1), categories=metro_categories)
+
+    def _passes_filters_at_end(self, metro_share, pax, metro_pax):
+        share_filter = self._configuration['Filters at end'].get('Metro market share', 0)
+        share_filter = share_filter if share_filter < 1 else share_filter / 100.0
+        return ((metro_share >= share_filter) &
+                (pax >= self._configuration['Filters at end'].get('Market carrier pax/day', 0)) &
+                (metro_pax >= self._configuration['Filters at end'].get('Metro pax/day', 0)))
+
+    def _pipeline_stages(self):
+        # Each stage's key combines the keys of its inputs with the configuration it reads.
+        configuration = self._configuration
+        share_filters = {name: value for name, value in configuration['Filters at beginning'].items() if name != 'Invalid carriers'}
+        stages = {
+            '_get_consolidated_data': ([], {
+                # Recorded in the cache, so that the data files' own cache keys do not hash them again
+                'Input files': [self._stage_cache.fingerprint(input_path) for input_path in self._input_paths],
+                'Invalid carriers': configuration['Filters at beginning']['Invalid carriers'],
+            }, self._get_consolidated_data),
+            '_add_daily_values': (['_get_consolidated_data'], {
+                section: configuration[section] for section in self._DAILY_VALUES_SECTIONS
+            }, self._add_daily_values),
+            '_filter_for_share': (['_add_daily_values'], {'Filters at beginning': share_filters}, self._filter_for_share),
+        }
+        steps = [
+            # Low-memory mode stores each step's output in single precision.
+            (self._add_fare_per_pax, {'Low memory': self._low_memory}),
+            (self._add_shares, {'ULCCs': configuration['ULCCs']}),
+            (self._add_distance_premiums, {'Distance bucket size': configuration['Distance bucket size']}),
+            (self._filter_at_end, {'Filters at end': configuration['Filters at end']}),
+        ]
+
+        if self._shared_enrichment or self._shards is not None:
+            def enrich(full_df, filtered_df):
+                self._full_df, self._filtered_df = full_df, filtered_df
+                return self._enrich_fresh_data()
+
+            enrichment_configuration = {'Shared enrichment': self._shared_enrichment}
+            for _, step_configuration in steps:
+                enrichment_configuration.update(step_configuration)
+            stages['_enrich_fresh_data'] = (['_add_daily_values', '_filter_for_share'], enrichment_configuration, enrich)
+            return stages
+
+        enriched = []
+        for variant, variant_input in [('unfiltered', '_add_daily_values'), ('filtered', '_filter_for_share')]:
+            for step, step_configuration in steps:
+                stages[f'{step.__name__} ({variant})'] = ([variant_input], step_configuration,
+                                                          lambda df, step=step: self._compact(step(df)))
+                variant_input = f'{step.__name__} ({variant})'
+            enriched.append(variant_input)
+        stages['Merge'] = (enriched, {}, lambda unfiltered_df, filtered_df: self._reorder_output_columns(
+            self._merge_enrichments(unfiltered_df, filtered_df)))
+        return stages
+
+    def _read_data_file(self, input_path):
+        with open_data_file(input_path) as f:
+            df = pd.read_csv(f, usecols=self._DATA_FILE_COLUMNS)
+        year, quarter = int(df['YEAR'][0]), int(df['QUARTER'][0])
+        df = self._filter_at_beginning(df)
+        df = df[['ORIGIN', 'DEST', 'TICKET_CARRIER', 'PASSENGERS', 'MARKET_FARE', 'NONSTOP_MILES']]
+        sketch = fare_sketch(df, self._FARE_SKETCH_KEYS) if self._fare_quantiles else None
+        df = self._consolidate_data_file(df)
+        return df, sketch, year, quarter
+
+    def _read_data_file_in_chunks(self, input_path):
+        # Each chunk is filtered and consolidated as it is read, so memory is bounded by the number of distinct
+        # markets rather than by the size of the file.
+        df = sketch = None
+        year = quarter = None
+        with open_data_file(input_path) as f:
+            for chunk in pd.read_csv(f, usecols=self._DATA_FILE_COLUMNS, dtype=self._DATA_FILE_DTYPES, chunksize=self._chunk_size):
+                if year is None:
+                    year, quarter = int(chunk['YEAR'].iloc[0]), int(chunk['QUARTER'].iloc[0])
+                chunk = self._filter_at_beginning(chunk)
+                chunk = chunk[['ORIGIN', 'DEST', 'TICKET_CARRIER', 'PASSENGERS', 'MARKET_FARE', 'NONSTOP_MILES']]
+                chunk = chunk.astype({'PASSENGERS': 'float64', 'NONSTOP_MILES': 'float64'})
+                if self._fare_quantiles:
+                    chunk_sketch = fare_sketch(chunk, self._FARE_SKETCH_KEYS)
+                    sketch = chunk_sketch if sketch is None else merge_sketches([sketch, chunk_sketch], self._FARE_SKETCH_KEYS)
+                chunk = self._consolidate_data_file(chunk)
+                df = chunk if df is None else self._consolidate_data_file(pd.concat([df, chunk], ignore_index=True))
+        df = df.astype({'ORIGIN': str, 'DEST': str, 'TICKET_CARRIER': str})
+        return df, sketch, year, quarter
 
     @staticmethod
     def _reorder_output_columns(df):
-        df = df.rename(columns={
+        df.columns = df.columns.map(lambda col: {
             'ORIGIN': 'Origin',
             'DEST': 'Destination',
             'NONSTOP_MILES': 'Nonstop miles',
@@ -385,9 +874,11 @@ class DB1B:
             'Dest market share': 'Carrier destination market share',
             'Origin metro market share': 'Carrier origin metro share',
             'Dest metro market share': 'Carrier destination metro share',
-        })
-        df.sort_values(['Origin metro', 'Destination metro', 'Carrier', 'Origin', 'Destination'], inplace=True)
-        return df[[
+        }.get(col, col))
+        # The rows are sorted and the output columns selected in a single copy of the frame.
+        sort_columns = ['Origin metro', 'Destination metro', 'Carrier', 'Origin', 'Destination']
+        rows = df[sort_columns].reset_index(drop=True).sort_values(sort_columns).index
+        output_columns = [
             'Origin metro',
             'Destination metro',
             'Origin',
@@ -440,7 +931,145 @@ class DB1B:
             'Metro distance total yield premium',
             'Metro distance total flight yield premium',
             'Metro\'s distance total yield premium',
-        ]]
+        ]
+        columns = df.columns.get_indexer(output_columns)
+        # get_indexer codes a missing column as -1, which iloc would take as the last column.
+        if (columns < 0).any():
+            raise KeyError(f'Output columns missing from the enriched data: {[col for col, column in zip(output_columns, columns) if column < 0]}')
+        return df.iloc[rows, columns]
+
+    def _report_peak_memory(self):
+        peak = peak_rss()
+        if peak is None:
+            print('Peak memory is not available on this platform')
+            return
+        peak_mb = peak / 1024 / 1024
+        if self._memory_budget_mb is None:
+            print(f'Peak memory: {peak_mb:.0f} MB')
+        else:
+            print(f'Peak memory: {peak_mb:.0f} MB of the {self._memory_budget_mb} MB budget '
+                  f'({peak_mb / self._memory_budget_mb * 100:.0f}%{", over budget" if peak_mb > self._memory_budget_mb else ""})')
+
+    @staticmethod
+    def _report_flow_validation(year, quarter, report):
+        concerning_routes = int(report['Concerning'].sum())
+        print(f'Found {concerning_routes} routes in Q{quarter} {year} file with concerningly uneven '
+              f'passenger flows ({round(concerning_routes/len(report)*100,2)}%)')
+
+    def _report_flow_validations(self, report):
+        for (_, year, quarter), file_report in report.groupby(['File', 'YEAR', 'QUARTER'], sort=False):
+            self._report_flow_validation(year, quarter, file_report)
+        if self._flow_report_path is not None:
+            report.to_csv(self._flow_report_path, index=False)
+        if self._strict_flow_validation and report['Concerning'].any():
+            concerning = report[report['Concerning']].groupby('File', sort=False).size()
+            raise FlowValidationError('Routes with concerningly uneven passenger flows found in ' +
+                                      ', '.join(f'{input_path} ({count})' for input_path, count in concerning.items()))
+
+    def _shard_distance_bucket_totals(self, df):
+        # The distance bucket totals _add_distance_premiums sums, over the same rows in the same order
+        metro_distance_df = self._metro_distance_frame(df)
+        # Rows of metro markets without a metro distance bucket are dropped before the flight yields are summed.
+        metro_distance_bucket_df = metro_distance_df[['Metro distance bucket', 'Origin metro', 'Destination metro']].drop_duplicates().dropna()
+        flight_df = df.merge(metro_distance_bucket_df, on=['Origin metro', 'Destination metro'])
+        flight_df['Distance bucket'] = self._distance_bucket(flight_df['NONSTOP_MILES'])
+        flight_df['Adj pax miles'] = flight_df['NONSTOP_MILES'] * flight_df['Adj pax/day']
+        return {
+            'Distance bucket': self._distance_bucket_totals(self._market_distance_frame(df)),
+            'Metro distance bucket': self._metro_distance_bucket_totals(metro_distance_df),
+            'Distance flight': self._distance_flight_totals(flight_df),
+        }
+
+    def _shard_metros(self, origin_metros):
+        # Assigns each origin metro to a shard, largest first, to whichever shard has the fewest rows so far
+        rows = np.bincount(origin_metros.cat.codes.to_numpy(), minlength=len(origin_metros.cat.categories))
+        shard_rows = []
+        shard_of_metro = np.full(len(rows), -1)
+        for metro in np.argsort(-rows, kind='stable'):
+            if rows[metro] == 0:
+                break
+            if len(shard_rows) < self._shards:
+                shard_rows.append(0)
+            shard = int(np.argmin(shard_rows))
+            shard_of_metro[metro] = shard
+            shard_rows[shard] += rows[metro]
+        return shard_of_metro
+
+    def _shard_share_totals(self, df):
+        # Keyed as _ShardGroupSums looks them up
+        group_sums = _GroupSums(df)
+        values = self._share_values(df)
+        not_ulcc = ~df['TICKET_CARRIER'].isin(self._configuration['ULCCs'])
+        totals = dict()
+        for col in ['DEST', 'Destination metro']:
+            totals[(col, 'TICKET_CARRIER'), False] = group_sums.totals([col, 'TICKET_CARRIER'], values)
+            totals[(col,), False] = group_sums.totals([col], values)
+            totals[(col,), True] = group_sums.totals([col], values, not_ulcc)
+        return totals
+
+    def _share_filter_mask(self, df):
+        # The rows of df that survive the share filter
+        filters = self._configuration['Filters at beginning']
+        market_pax_filter = filters.get('Market pax/day', 0)
+        metro_pax_filter = filters.get('Metro pax/day', 0)
+        market_share_filter = filters.get('Market share', 0)
+        metro_share_filter = filters.get('Metro share', 0)
+        do_not_filter = filters['Do not filter if'].get('Market carrier pax/day', 10000)
+
+        keep = (df['Pax/day'] >= filters.get('Market carrier pax/day', 0)).to_numpy(copy=True)
+        df = df[keep]
+
+        # Group totals are kept up to date from the rows each step removes, rather than regrouped on every pass.
+        pax = df['Pax/day'].to_numpy(dtype='float64')
+        markets = _GroupTotals(df.groupby(['ORIGIN', 'DEST'], sort=False, observed=True).ngroup().to_numpy(), pax)
+        metros = _GroupTotals(df.groupby(['Origin metro', 'Destination metro'], sort=False, observed=True).ngroup().to_numpy(), pax)
+        carrier_metros = _GroupTotals(df.groupby(['Origin metro', 'Destination metro', 'TICKET_CARRIER'], sort=False, observed=True).ngroup().to_numpy(), pax)
+        rows = _GroupTotals(np.arange(len(df)), pax)
+        group_totals = [rows, markets, metros, carrier_metros]
+        alive = np.ones(len(df), dtype=bool)
+
+        def remove(keep):
+            removed = alive & ~keep
+            alive[removed] = False
+            for totals in group_totals:
+                totals.remove(removed)
+            return int(removed.sum())
+
+        passes = 0
+        removed_rows = None
+        remaining_rows = len(df)
+        while removed_rows != 0:
+            passes += 1
+            with self._profiler.stage(f'Share filter pass {passes}', (remaining_rows, len(df.columns))) as stage:
+                removed_by_market_pax = remove(markets.meets(market_pax_filter, alive))
+                removed_by_metro_pax = remove(metros.meets(metro_pax_filter, alive))
+
+                market_share_ok = _GroupTotals.share_meets(rows, markets, market_share_filter, alive)
+                metro_share_ok = _GroupTotals.share_meets(carrier_metros, metros, metro_share_filter, alive)
+                removed_by_share = remove((market_share_ok & metro_share_ok) | (pax > do_not_filter))
+
+                removed_rows = removed_by_market_pax + removed_by_metro_pax + removed_by_share
+                remaining_rows -= removed_rows
+                stage.output((remaining_rows, len(df.columns)))
+            if self._debug:
+                print(f'Share filter pass {passes}: removed {removed_rows} rows ({removed_by_market_pax} for market pax/day, '
+                      f'{removed_by_metro_pax} for metro pax/day, {removed_by_share} for market or metro share)')
+
+        if self._debug:
+            print(f'Share filter converged after {passes} passes with {alive.sum()} of {len(df)} rows remaining')
+
+        keep[keep] = alive
+        return keep
+
+    @staticmethod
+    def _share_values(df):
+        return {
+            'Pax/day': df['Pax/day'],
+            'Adj pax/day': df['Adj pax/day'],
+            'Revenue/day': df['Revenue/day'],
+            'Total revenue/day': df['Total revenue/day'],
+            'Pax miles': df['NONSTOP_MILES'] * df['Pax/day'],
+        }
 
     @staticmethod
     def _timeframe_length(year, quarter):
@@ -455,35 +1084,213 @@ class DB1B:
         #Q4
         return 31 + 30 + 31
 
-    def _validate_data_file(self, original_df):
-        df = original_df.copy()
-        year = df['YEAR'].iloc[0]
-        quarter = df['QUARTER'].iloc[0]
-        df['Pax/day'] = df['PASSENGERS'] / (0.1 * self._timeframe_length(year, quarter))
-        df = df[['ORIGIN', 'DEST', 'Pax/day']]
-        df = df.groupby(['ORIGIN', 'DEST'], as_index=False).sum()
-        df_left = df.copy()
-        df = df[df['ORIGIN'] < df['DEST']]
-        df_left = df_left[df_left['DEST'] < df_left['ORIGIN']]
-        df['Original route name'] = df['ORIGIN'] + '-' + df['DEST']
-        df_left['Original route name'] = df_left['DEST'] + '-' + df_left['ORIGIN']
-        df = df.merge(df_left, on='Original route name', how='outer')
-        df.fillna(0, inplace=True)
-        df.rename(columns={'Pax/day_x': 'Right', 'Pax/day_y': 'Left'}, inplace=True)
-        df = df[['Original route name', 'Right', 'Left']]
-        df['Diff'] = df['Right'] - df['Left']
-        df['Percent diff'] = df['Right'] / df['Left'] - 1
-        max_diff = self._configuration['Passenger flow validation']['Quantity different']
-        max_pct_diff = self._configuration['Passenger flow validation']['Percent different']
-        max_pct_diff = max_pct_diff if -1 < max_pct_diff < 1 else max_pct_diff / 100.0
-        df_concerning = pd.concat([df[df['Diff'] > max_diff], df[df['Diff'] < -max_diff]])
-        df_concerning = pd.concat([df_concerning[df_concerning['Percent diff'] > max_pct_diff], df_concerning[df_concerning['Percent diff'] < -max_pct_diff]])
-        print(f'Found {len(df_concerning)} routes in Q{quarter} {year} file with concerningly uneven passenger flows '
-              f'({round(len(df_concerning)/len(df)*100,2)}%)')
+    def _unfiltered_output_columns(self, df):
+        return df[[col for col in df.columns if col in self._MERGE_COLUMNS or ('yield' not in col and 'premium' not in col)]]
+
+    def _validate_flows_in_background(self, input_path, df, year, quarter):
+        # Passengers per directional route are unchanged by consolidation, so the consolidated data file is validated.
+        if self._flow_validator is None:
+            self._flow_validator = ThreadPoolExecutor(max_workers=1)
+        flow_validation = self._configuration['Passenger flow validation']
+        validation = self._flow_validator.submit(validate_flows, df, self._timeframe_length(year, quarter),
+                                                 flow_validation['Quantity different'],
+                                                 flow_validation['Percent different'])
+        self._flow_validations.append((input_path, year, quarter, validation))
+
+    def _write_output(self, merged_df, output_path=None):
+        with self._profiler.stage('Write output', merged_df.shape):
+            self._writer.write(merged_df, output_path or self._output_path)
+
+        if isinstance(self._profiler, StageProfiler):
+            report_path = self._profiler.write(self._output_path, self._input_paths)
+            print(self._profiler.summary())
+            print(f'Wrote profile to {report_path}')
+
+
+class _GroupSums:
+    # Each group's code combines the codes of its keys, so sums are broadcast back to rows by position, not merged.
+    def __init__(self, df):
+        self._df = df
+        self._index = df.index
+        self._rows = None
+        self._column_codes = dict()
+        self._group_codes = dict()
+
+    def codes(self, keys):
+        keys = tuple(keys)
+        if keys not in self._group_codes:
+            codes = np.zeros(len(self._df), dtype='int64')
+            for key in keys:
+                if key not in self._column_codes:
+                    column_codes, uniques = pd.factorize(self._df[key], use_na_sentinel=False)
+                    self._column_codes[key] = (column_codes, len(uniques))
+                column_codes, column_groups = self._column_codes[key]
+                codes = pd.factorize(codes * column_groups + column_codes)[0]
+            self._group_codes[keys] = (codes, codes.max() + 1 if len(codes) else 0)
+        codes, groups = self._group_codes[keys]
+        return (codes, groups) if self._rows is None else (codes[self._rows], groups)
+
+    def filtered(self, rows):
+        # Shares the codes of the whole frame
+        group_sums = copy.copy(self)
+        group_sums._rows = np.asarray(rows)
+        group_sums._index = pd.RangeIndex(int(group_sums._rows.sum()))
+        return group_sums
+
+    def sums(self, keys, values, rows=None):
+        codes, sums = self.totals(keys, values, rows)
+        return pd.DataFrame(sums.to_numpy()[codes], index=self._index, columns=sums.columns)
+
+    def totals(self, keys, values, rows=None):
+        # The sums of each group of keys, one row per group, along with each row's group
+        codes, groups = self.codes(keys)
+        values = pd.DataFrame({column: np.asarray(column_values) for column, column_values in values.items()})
+        summed_codes = codes
+        if rows is not None:
+            rows = np.asarray(rows)
+            values = values[rows]
+            summed_codes = codes[rows]
+        # Summed by pandas rather than np.bincount, so that totals round as a groupby's do around the filter thresholds
+        sums = values.groupby(pd.Categorical.from_codes(summed_codes, categories=pd.RangeIndex(groups)), observed=False).sum()
+        return codes, sums
+
+
+class _ShardGroupSums(_GroupSums):
+    # Given sums are keyed by their keys and by whether they count only some rows.
+    def __init__(self, df, shard_totals):
+        super().__init__(df)
+        self._shard_totals = shard_totals
+
+    def sums(self, keys, values, rows=None):
+        if (tuple(keys), rows is not None) not in self._shard_totals:
+            return super().sums(keys, values, rows)
+        codes, sums = self._shard_totals[tuple(keys), rows is not None]
+        return pd.DataFrame(sums.to_numpy()[codes], index=self._index, columns=sums.columns)
+
+
+class _GroupTotals:
+    # Running totals decide only clear comparisons; those within rounding distance fall back to exact groupby sums.
+    _TOLERANCE = 1e-9
+
+    def __init__(self, codes, pax):
+        self.codes = codes
+        self.totals = np.bincount(codes, weights=pax)
+        # Bounds the rounding error the running totals can accumulate
+        self.magnitudes = self.totals.copy()
+        self._pax = pax
+
+    def exact_totals(self, groups, alive):
+        totals = self.totals.copy()
+        rows = alive & np.isin(self.codes, groups)
+        exact = pd.Series(self._pax[rows]).groupby(self.codes[rows]).sum()
+        totals[groups] = 0
+        totals[exact.index.to_numpy()] = exact.to_numpy()
+        return totals
+
+    def meets(self, threshold, alive):
+        meets = self.totals >= threshold
+        has_rows = np.bincount(self.codes[alive], minlength=len(self.totals)) > 0
+        uncertain = has_rows & (np.abs(self.totals - threshold) <= self._TOLERANCE * (self.magnitudes + abs(threshold)))
+        if uncertain.any():
+            meets[uncertain] = self.exact_totals(np.flatnonzero(uncertain), alive)[uncertain] >= threshold
+        return meets[self.codes]
+
+    def remove(self, removed):
+        self.totals -= np.bincount(self.codes[removed], weights=self._pax[removed], minlength=len(self.totals))
+
+    @classmethod
+    def share_meets(cls, numerators, denominators, threshold, alive):
+        row_numerators = numerators.totals[numerators.codes]
+        row_denominators = denominators.totals[denominators.codes]
+        meets = row_numerators >= threshold * row_denominators
+        uncertain = alive & (np.abs(row_numerators - threshold * row_denominators) <= cls._TOLERANCE * (
+                numerators.magnitudes[numerators.codes] + threshold * denominators.magnitudes[denominators.codes]))
+        if uncertain.any():
+            row_numerators = numerators.exact_totals(np.unique(numerators.codes[uncertain]), alive)[numerators.codes]
+            row_denominators = denominators.exact_totals(np.unique(denominators.codes[uncertain]), alive)[denominators.codes]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                meets[uncertain] = row_numerators[uncertain] / row_denominators[uncertain] >= threshold
+        return meets
+
+
+def _copy(df):
+    # Under copy-on-write, a copy shares its data until either frame is modified; otherwise the data is copied now.
+    return df.copy(deep=not pd.options.mode.copy_on_write)
+
+
+def _enrich_shard(db1b, shard):
+    # Runs in a worker process, so the stages it profiles have to be handed back to the parent along with the output.
+    db1b._profiler = type(db1b._profiler)()
+    enriched = []
+    for variant, (df, share_totals, distance_bucket_totals) in shard.items():
+        db1b._shard_totals = {'Shares': share_totals, 'Distance buckets': distance_bucket_totals}
+        enriched.append(db1b._enrich_variant(df, variant))
+    db1b._shard_totals = None
+    return db1b._merge_enrichments(*enriched), db1b._profiler.records()
+
+
+def _ingest_data_file(db1b, input_path):
+    # Runs in a worker process on a copy of the DB1B object, so the quarters it reads, the fares it sketches, and the
+    # stages it profiles have to be handed back to the parent along with the consolidated data.
+    db1b._analysis_length = 0
+    db1b._quarters = []
+    db1b._fare_sketches = []
+    db1b._profiler = type(db1b._profiler)()
+    df = db1b._get_data_file(input_path)
+    return df, db1b._quarters, db1b._fare_sketches, db1b._profiler.records()
 
 
 def main():
-    db1b = DB1B(sys.argv[1], sys.argv[2:])
+    parser = argparse.ArgumentParser(description='Enrich DB1B market data.')
+    parser.add_argument('output_path', help='path to which the output is written')
+    parser.add_argument('input_paths', nargs='+',
+                        help='paths to DB1B market data files, zip archives as downloaded from BTS, compressed CSVs, '
+                             'directories of them, or glob patterns matching them')
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help='read each input file this many rows at a time to bound memory use')
+    parser.add_argument('--parallel', action='store_true', help='ingest input files in parallel worker processes')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes to use with --parallel (default: number of CPUs)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory in which to cache consolidated input files between runs')
+    parser.add_argument('--cache-max-size', type=int, default=DataFileCache.DEFAULT_MAX_SIZE_MB,
+                        help='size in MB above which the least recently used cache entries are evicted')
+    parser.add_argument('--debug', action='store_true', help='report the passes made by the share filter')
+    parser.add_argument('--shared-enrichment', action='store_true',
+                        help='enrich the unfiltered and filtered data together, sharing grouped totals between them')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default=None,
+                        help='format to write the output in (default: from the output path\'s extension)')
+    parser.add_argument('--float-precision', type=int, default=None,
+                        help='significant digits to write floats to in CSV output (default: full precision)')
+    parser.add_argument('--profile', action='store_true',
+                        help='record the time, memory, and row counts of each stage and write them next to the output')
+    parser.add_argument('--flow-report', default=None,
+                        help='path to write a CSV comparing the passengers flown in each direction of every route to')
+    parser.add_argument('--strict-flow-validation', action='store_true',
+                        help='fail without writing the output if any route has concerningly uneven passenger flows')
+    parser.add_argument('--low-memory', action='store_true',
+                        help='store derived values in single precision and defer copies, to reduce peak memory use')
+    parser.add_argument('--memory-budget', type=int, default=None,
+                        help='peak memory in MB to report the run\'s peak memory against')
+    parser.add_argument('--shards', type=int, default=None,
+                        help='enrich the data in this many shards of origin metros, in parallel worker processes')
+    parser.add_argument('--cache-stages', action='store_true',
+                        help='also cache the output of each stage in the cache directory, and rerun only the stages '
+                             'after the latest one whose input and configuration are unchanged')
+    parser.add_argument('--explain-cache', action='store_true',
+                        help='with --cache-stages, report which stages were reused or recomputed, and why')
+    parser.add_argument('--fare-quantiles', action='store_true',
+                        help='sketch the distribution of fares while reading the input files, and add the quartiles '
+                             'and 90th percentile of each carrier market\'s and metro market\'s fares and yields')
+    args = parser.parse_args()
+
+    db1b = DB1B(args.output_path, args.input_paths, chunk_size=args.chunk_size, parallel=args.parallel,
+                workers=args.workers, cache_dir=args.cache_dir, cache_max_size_mb=args.cache_max_size,
+                debug=args.debug, shared_enrichment=args.shared_enrichment, profile=args.profile,
+                output_format=args.output_format, float_precision=args.float_precision,
+                flow_report_path=args.flow_report, strict_flow_validation=args.strict_flow_validation,
+                low_memory=args.low_memory, memory_budget_mb=args.memory_budget, shards=args.shards,
+                cache_stages=args.cache_stages, explain_cache=args.explain_cache, fare_quantiles=args.fare_quantiles)
     db1b.enrich()
 
 
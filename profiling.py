@@ -0,0 +1,141 @@
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+class StageProfiler:
+    """Records the wall time, CPU time, peak RSS growth, and input and output shapes of pipeline stages.
+
+    Stages may be nested; each record names the stage that encloses it.
+    """
+
+    def __init__(self):
+        self._records = []
+        self._open = []
+
+    def add(self, records):
+        # Records made in another process, eg., by a worker ingesting a data file, nest in the stage open here.
+        enclosing = self._open[-1] if self._open else None
+        for record in records:
+            if enclosing is not None:
+                record = dict(record, Parent=enclosing if record['Parent'] is None else f'{enclosing} > {record["Parent"]}')
+            self._records.append(record)
+
+    def records(self):
+        return list(self._records)
+
+    def report(self, output_path, input_paths):
+        return {
+            'Output path': os.path.abspath(output_path),
+            'Input paths': [os.path.abspath(path) for path in input_paths],
+            'Wall seconds': sum(record['Wall seconds'] for record in self._records if record['Parent'] is None),
+            'Stages': self.records(),
+        }
+
+    def stage(self, name, shape=None):
+        return _Stage(self, name, shape)
+
+    def summary(self):
+        lines = []
+        for record in self._records:
+            depth = 0 if record['Parent'] is None else record['Parent'].count(' > ') + 1
+            rows = f'{record["Input rows"] if record["Input rows"] is not None else "-":>9} -> {record["Output rows"] if record["Output rows"] is not None else "-":<9}'
+            peak = f'{record["Peak RSS delta MB"]:+8.0f} MB' if record['Peak RSS delta MB'] is not None else ''
+            lines.append(f'{"  " * depth + record["Stage"]:<48.48} {record["Wall seconds"]:8.2f} s wall {record["CPU seconds"]:8.2f} s CPU {peak}  {rows} rows')
+        return '\n'.join(lines)
+
+    def write(self, output_path, input_paths):
+        path = self.report_path(output_path)
+        with open(path, 'w') as f:
+            json.dump(self.report(output_path, input_paths), f, indent=2)
+        return path
+
+    @staticmethod
+    def report_path(output_path):
+        return os.path.splitext(output_path)[0] + '.profile.json'
+
+    def _enter(self, name):
+        # Records are kept in the order stages start, so that enclosing stages come before the stages they enclose.
+        parent = self._open[-1] if self._open else None
+        self._open.append(name if parent is None else f'{parent} > {name}')
+        record = {'Stage': name, 'Parent': parent, 'Process': os.getpid()}
+        self._records.append(record)
+        return record
+
+    def _exit(self):
+        self._open.pop()
+
+
+class NullProfiler:
+    """Stands in for a StageProfiler when profiling is off, at the cost of a method call per stage."""
+
+    def add(self, records):
+        pass
+
+    def records(self):
+        return []
+
+    def stage(self, name, shape=None):
+        return _NULL_STAGE
+
+
+class _Stage:
+    def __init__(self, profiler, name, shape):
+        self._profiler = profiler
+        self._name = name
+        self._input_shape = shape
+        self._output_shape = None
+
+    def __enter__(self):
+        self._record = self._profiler._enter(self._name)
+        self._peak_rss = peak_rss()
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        peak = peak_rss()
+        self._profiler._exit()
+        self._record.update({
+            'Wall seconds': wall,
+            'CPU seconds': cpu,
+            'Peak RSS delta MB': (peak - self._peak_rss) / 1024 / 1024 if peak is not None else None,
+            'Input rows': self._input_shape[0] if self._input_shape is not None else None,
+            'Input columns': self._input_shape[1] if self._input_shape is not None else None,
+            'Output rows': self._output_shape[0] if self._output_shape is not None else None,
+            'Output columns': self._output_shape[1] if self._output_shape is not None else None,
+        })
+        return False
+
+    def output(self, shape):
+        self._output_shape = shape
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def output(self, shape):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def peak_rss():
+    # The high-water mark of the process's resident set, in bytes.  Linux reports it in kilobytes and macOS in bytes.
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
@@ -0,0 +1,217 @@
+import argparse
+import json
+import math
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+
+class EnrichedResults:
+    """An enriched output loaded into memory once, with indexes for answering filter, sort, and top-N queries.
+
+    Each indexed column is coded as integers, with the positions of the rows holding each value kept sorted, so an
+    equality filter is a lookup rather than a scan.  The order of the rows by a column is computed the first time the
+    column is sorted or filtered on by range, and kept.  A query materializes only the rows that match its most
+    selective filter and checks its other filters against those rows alone.
+    """
+
+    INDEXED_COLUMNS = ['Origin metro', 'Destination metro', 'Origin', 'Destination', 'Carrier', 'Distance bucket']
+
+    def __init__(self, df):
+        self._df = df
+        self._columns = {col: df[col].to_numpy() for col in df.columns}
+        self._codes = {}
+        self._value_codes = {}
+        self._postings = {}
+        for col in self.INDEXED_COLUMNS:
+            codes, values = pd.factorize(df[col])
+            # Rows grouped by value, in their original order within each value
+            order = np.argsort(codes, kind='stable')
+            boundaries = np.searchsorted(codes[order], np.arange(len(values) + 1))
+            self._codes[col] = codes
+            self._value_codes[col] = {value: code for code, value in enumerate(values)}
+            self._postings[col] = {value: order[boundaries[code]:boundaries[code + 1]] for code, value in enumerate(values)}
+        self._sort_orders = {}
+
+    @classmethod
+    def load(cls, path):
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.csv':
+            df = pd.read_csv(path, index_col=0)
+        elif extension == '.parquet':
+            df = pd.read_parquet(path)
+        elif extension == '.feather':
+            df = pd.read_feather(path)
+        else:
+            assert extension == '.arrow', f'Unknown output format {extension}; expected .csv, .parquet, .feather, or .arrow'
+            import pyarrow as pa
+            with pa.memory_map(path) as source:
+                df = pa.ipc.open_file(source).read_pandas()
+        return cls(df)
+
+    def columns(self):
+        return list(self._df.columns)
+
+    def query(self, filters=None, minimums=None, maximums=None, sort=None, descending=True, limit=None, columns=None):
+        """Returns the rows matching every filter, sorted and limited, along with the number of rows that match.
+
+        filters maps indexed columns to a value or to a list of values; minimums and maximums map any numeric column
+        to an inclusive bound.
+        """
+        filters = {col: values if isinstance(values, (list, tuple, set)) else [values] for col, values in (filters or {}).items()}
+        minimums = minimums or {}
+        maximums = maximums or {}
+        assert all(col in self._postings for col in filters), f'Only {self.INDEXED_COLUMNS} can be filtered by value'
+        for col in list(minimums) + list(maximums) + ([sort] if sort else []):
+            assert col in self._columns, f'Unknown column {col}'
+
+        rows = self._candidate_rows(filters, minimums, maximums)
+        for col, values in filters.items():
+            wanted = [self._value_codes[col][value] for value in values if value in self._value_codes[col]]
+            rows = rows[np.isin(self._codes[col][rows], wanted)]
+        for col, minimum in minimums.items():
+            rows = rows[self._columns[col][rows] >= minimum]
+        for col, maximum in maximums.items():
+            rows = rows[self._columns[col][rows] <= maximum]
+
+        count = len(rows)
+        if sort is not None:
+            rows = self._sorted(rows, sort, descending, limit)
+        elif limit is not None:
+            rows = rows[:limit]
+        result = self._df.iloc[rows]
+        return (result[columns] if columns else result), count
+
+    def _candidate_rows(self, filters, minimums, maximums):
+        # The rows matching the most selective filter; the other filters are checked against these rows alone.
+        candidates = []
+        for col, values in filters.items():
+            postings = [self._postings[col][value] for value in values if value in self._postings[col]]
+            candidates.append(np.sort(np.concatenate(postings)) if postings else np.empty(0, dtype=np.intp))
+        for col in set(minimums) | set(maximums):
+            order, sorted_values = self._sort_order(col, descending=False)
+            start = np.searchsorted(sorted_values, minimums[col], side='left') if col in minimums else 0
+            end = np.searchsorted(sorted_values, maximums[col], side='right') if col in maximums else len(order)
+            candidates.append(np.sort(order[start:end]))
+        if not candidates:
+            return np.arange(len(self._df))
+        return min(candidates, key=len)
+
+    def _sort_order(self, col, descending):
+        # NaNs sort last either way, past every bound.
+        if (col, descending) not in self._sort_orders:
+            order = np.argsort(_sort_keys(self._columns[col], descending), kind='stable')
+            self._sort_orders[col, descending] = order, self._columns[col][order]
+        return self._sort_orders[col, descending]
+
+    def _sorted(self, rows, col, descending, limit):
+        if len(rows) == len(self._df):
+            return self._sort_order(col, descending)[0][:limit]
+        keys = _sort_keys(self._columns[col][rows], descending)
+        if limit is not None and limit < len(rows):
+            top = np.argpartition(keys, limit - 1)[:limit]
+            return rows[top[np.argsort(keys[top], kind='stable')]]
+        return rows[np.argsort(keys, kind='stable')]
+
+
+class _QueryHandler(BaseHTTPRequestHandler):
+    """Answers GET /columns and GET /query?<column>=<value>&min.<column>=<bound>&sort=<column>&limit=<rows>."""
+
+    results = None
+    _RESERVED_PARAMETERS = ['sort', 'ascending', 'limit', 'columns']
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parameters = parse_qs(url.query)
+        try:
+            if url.path == '/columns':
+                self._respond(200, {'columns': self.results.columns()})
+            elif url.path == '/query':
+                self._respond(200, self._query(parameters))
+            else:
+                self._respond(404, {'error': f'Unknown path {url.path}'})
+        except (AssertionError, KeyError, TypeError, ValueError) as e:
+            self._respond(400, {'error': str(e)})
+
+    def log_message(self, format, *args):
+        pass
+
+    def _query(self, parameters):
+        filters, minimums, maximums = {}, {}, {}
+        for name, values in parameters.items():
+            if name in self._RESERVED_PARAMETERS:
+                continue
+            if name.startswith('min.'):
+                minimums[name[len('min.'):]] = float(values[-1])
+            elif name.startswith('max.'):
+                maximums[name[len('max.'):]] = float(values[-1])
+            else:
+                filters[name] = [self._value(name, value) for value in values]
+        df, count = self.results.query(
+            filters=filters,
+            minimums=minimums,
+            maximums=maximums,
+            sort=parameters.get('sort', [None])[-1],
+            descending=parameters.get('ascending', ['false'])[-1].lower() != 'true',
+            limit=int(parameters['limit'][-1]) if 'limit' in parameters else None,
+            columns=parameters['columns'][-1].split(',') if 'columns' in parameters else None,
+        )
+        rows = [{col: _json_value(value) for col, value in zip(df.columns, row)} for row in df.itertuples(index=False)]
+        return {'count': count, 'rows': rows}
+
+    def _respond(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _value(self, col, value):
+        # Query strings are text, so values of numeric columns such as the distance bucket are converted.
+        assert col in EnrichedResults.INDEXED_COLUMNS, f'{col} is not one of the indexed columns {EnrichedResults.INDEXED_COLUMNS}'
+        return float(value) if pd.api.types.is_numeric_dtype(self.results._df[col]) else value
+
+
+def _sort_keys(values, descending):
+    # Text columns are sorted by their codes in sorted order, so that a descending order negates numbers either way.
+    # Missing values are coded as NaN, which sorts last either way.
+    if values.dtype.kind not in 'iuf':
+        codes, _ = pd.factorize(values, sort=True)
+        values = np.where(codes >= 0, codes, np.nan)
+    return -values if descending else values
+
+
+def _json_value(value):
+    if isinstance(value, (np.integer, np.floating)):
+        value = value.item()
+    return None if isinstance(value, float) and math.isnan(value) else value
+
+
+def serve(results, host='127.0.0.1', port=8000):
+    handler = type('QueryHandler', (_QueryHandler,), {'results': results})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f'Serving queries on http://{host}:{server.server_port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve queries over an enriched DB1B output.')
+    parser.add_argument('results_path', help='path to an output written by main.py')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on (default: 8000)')
+    args = parser.parse_args()
+
+    serve(EnrichedResults.load(args.results_path), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import argparse
+from collections import deque
+
+from cache import DataFileCache
+from inputs import expand_input_paths
+from main import DB1B
+from writers import OUTPUT_FORMATS
+
+
+class RollingWindows:
+    """Enriches each run of consecutive quarters, eg., each trailing four quarters, from per-quarter additive state.
+
+    Each quarter's data file is read and consolidated once, into passengers and fares keyed by origin, destination,
+    carrier, and nonstop miles.  The window's state is the sum of its quarters' states; moving the window adds the new
+    quarter's state and subtracts the expired quarter's, and the enrichment is run from the window's sums.
+
+    Passenger sums, and so the filters, match those of a run over the window's files.  Fare sums can differ from them
+    in the last few bits, since they are reached by different sequences of additions and subtractions.
+    """
+
+    _KEYS = ['ORIGIN', 'DEST', 'TICKET_CARRIER', 'NONSTOP_MILES']
+
+    def __init__(self, output_path_template, input_paths, window=4, chunk_size=None, cache_dir=None,
+                 cache_max_size_mb=DataFileCache.DEFAULT_MAX_SIZE_MB, shared_enrichment=False, output_format=None,
+                 float_precision=None):
+        assert '{year}' in output_path_template and '{quarter}' in output_path_template
+        assert window > 0
+        input_paths = expand_input_paths(input_paths)
+        assert len(input_paths) >= window
+        self._output_path_template = output_path_template
+        self._input_paths = input_paths
+        self._window = window
+        self._options = {
+            'shared_enrichment': shared_enrichment,
+            'output_format': output_format,
+            'float_precision': float_precision,
+        }
+        self._reader = DB1B(self._output_path(0, 0), input_paths, chunk_size=chunk_size, cache_dir=cache_dir,
+                            cache_max_size_mb=cache_max_size_mb, **self._options)
+
+    def run(self):
+        quarters = deque()
+        state = None
+        for input_path in self._input_paths:
+            quarter_state, year, quarter = self._read_quarter(input_path)
+            if quarters:
+                previous_year, previous_quarter = quarters[-1][1:3]
+                assert (year, quarter) == self._next_quarter(previous_year, previous_quarter), \
+                    f'{input_path} does not hold the quarter after Q{previous_quarter} {previous_year}'
+            quarters.append((quarter_state, year, quarter, input_path))
+            state = quarter_state if state is None else state.add(quarter_state, fill_value=0)
+
+            if len(quarters) > self._window:
+                expired_state = quarters.popleft()[0]
+                state = state.sub(expired_state, fill_value=0)
+                # Markets flown only in the expired quarter leave the window.
+                state = state[state['Quarters'] > 0]
+            if len(quarters) == self._window:
+                self._enrich_window(state, [quarter_info[1:] for quarter_info in quarters])
+        self._reader.flow_validation_report()
+
+    def _enrich_window(self, state, quarters):
+        year, quarter = quarters[-1][:2]
+        db1b = DB1B(self._output_path(year, quarter), [input_path for _, _, input_path in quarters], **self._options)
+        consolidated_df = state.sort_index().drop(columns='Quarters').reset_index()
+        db1b.write(db1b.enrich_frames(consolidated_df, [(window_year, window_quarter) for window_year, window_quarter, _ in quarters]))
+
+    @staticmethod
+    def _next_quarter(year, quarter):
+        return (year, quarter + 1) if quarter < 4 else (year + 1, 1)
+
+    def _output_path(self, year, quarter):
+        return self._output_path_template.format(year=year, quarter=quarter)
+
+    def _read_quarter(self, input_path):
+        df, [(year, quarter)] = self._reader.ingest([input_path])
+        # Keyed by value, since each quarter's keys are categorized differently
+        df = df.astype({'ORIGIN': str, 'DEST': str, 'TICKET_CARRIER': str})
+        state = df.set_index(self._KEYS)[['PASSENGERS', 'MARKET_FARE']].astype('float64')
+        # Counts the window's quarters each market was flown in, so that markets can leave the window.
+        state['Quarters'] = 1
+        return state, year, quarter
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Enrich DB1B market data over rolling windows of quarters.')
+    parser.add_argument('output_path_template',
+                        help='path to write each window\'s output to, with {year} and {quarter} replaced by the '
+                             'window\'s last quarter, eg., out-{year}-q{quarter}.csv')
+    parser.add_argument('input_paths', nargs='+', help='paths to DB1B market data files, one per consecutive quarter, or directories of '
+                             'them or glob patterns matching them, whose files sort in quarter order')
+    parser.add_argument('--window', type=int, default=4, help='number of quarters in each window (default: 4)')
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help='read each input file this many rows at a time to bound memory use')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory in which to cache consolidated input files between runs')
+    parser.add_argument('--cache-max-size', type=int, default=DataFileCache.DEFAULT_MAX_SIZE_MB,
+                        help='size in MB above which the least recently used cache entries are evicted')
+    parser.add_argument('--shared-enrichment', action='store_true',
+                        help='enrich the unfiltered and filtered data together, sharing grouped totals between them')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default=None,
+                        help='format to write the outputs in (default: from the output path\'s extension)')
+    parser.add_argument('--float-precision', type=int, default=None,
+                        help='significant digits to write floats to in CSV outputs (default: full precision)')
+    args = parser.parse_args()
+
+    rolling_windows = RollingWindows(args.output_path_template, args.input_paths, window=args.window,
+                                     chunk_size=args.chunk_size, cache_dir=args.cache_dir,
+                                     cache_max_size_mb=args.cache_max_size, shared_enrichment=args.shared_enrichment,
+                                     output_format=args.output_format, float_precision=args.float_precision)
+    rolling_windows.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+
+
+# Each value is kept as the bin it falls in rather than as itself, so a sketch holds at most _BINS rows per group and
+# measure however many tickets it sketches.  Bins grow geometrically, so every value in a bin is within
+# _RELATIVE_ACCURACY of the value the bin stands for.
+_RELATIVE_ACCURACY = 0.01
+_GAMMA = (1 + _RELATIVE_ACCURACY) / (1 - _RELATIVE_ACCURACY)
+_BINS = 1024
+# The value each measure's first bin ends at; values up to it, such as award tickets' fares, fall in the first bin.
+_MINIMUMS = {'fare/pax': 0.01, 'yield': 0.0001}
+_MEASURE_DTYPE = pd.CategoricalDtype(list(_MINIMUMS))
+QUANTILES = {'p25': 0.25, 'median': 0.5, 'p75': 0.75, 'p90': 0.9}
+
+
+def fare_sketch(df, keys):
+    """Sketches the distribution of the fare and yield paid by each passenger in each group of ticket rows.
+
+    Each row's passengers paid its market fare divided among them.  Returns one row per group, measure, and bin holding
+    the number of passengers whose fare or yield fell in the bin.  Sketches are merged by adding up their bins, so
+    sketches of chunks or quarters merge into the sketch of all of them.
+    """
+    passengers = df['PASSENGERS'].to_numpy(dtype='float64')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fares = df['MARKET_FARE'].to_numpy(dtype='float64') / passengers
+        yields = fares / df['NONSTOP_MILES'].to_numpy(dtype='float64')
+    sketches = []
+    for measure, values in [('fare/pax', fares), ('yield', yields)]:
+        # Rows without passengers, or without a distance to take a yield over, have no value to sketch.
+        rows = (passengers > 0) & ~np.isnan(values)
+        sketch = df.loc[rows, keys].reset_index(drop=True)
+        sketch['Measure'] = pd.Series(measure, index=sketch.index, dtype=_MEASURE_DTYPE)
+        sketch['Bin'] = _bins(values[rows], _MINIMUMS[measure])
+        sketch['PASSENGERS'] = passengers[rows]
+        sketches.append(sketch)
+    return merge_sketches(sketches, keys)
+
+
+def merge_sketches(sketches, keys):
+    """Adds up the bins of sketches of the same groups, eg., of several chunks or quarters.
+
+    Each row's group, measure, and bin are coded as one integer, so that the bins are summed by bincount.  Passengers
+    are whole numbers, so their sums are exact.
+    """
+    # Keys are categorized after concatenation, since sketches' categories differ and concatenating them drops them.
+    sketch = pd.concat(sketches, ignore_index=True).astype({key: 'category' for key in keys})
+    codes = np.zeros(len(sketch), dtype=np.int64)
+    for col in keys + ['Measure']:
+        codes = codes * len(sketch[col].cat.categories) + sketch[col].cat.codes.to_numpy()
+    codes = codes * _BINS + sketch['Bin'].to_numpy()
+    bin_codes, first, bin_of_row = np.unique(codes, return_index=True, return_inverse=True)
+    merged = sketch.loc[first, keys + ['Measure', 'Bin']].reset_index(drop=True)
+    merged['PASSENGERS'] = np.bincount(bin_of_row, weights=sketch['PASSENGERS'].to_numpy(), minlength=len(bin_codes))
+    return merged
+
+
+def sketch_quantiles(sketch, keys):
+    """Returns the quantiles of each group's fares and yields: one row per group, with a column per measure and quantile.
+
+    A quantile is the value of the first bin at which the passengers in the group's bins, counted from the lowest,
+    reach that share of the group's passengers.
+    """
+    quantiles = None
+    for measure, minimum in _MINIMUMS.items():
+        measure_sketch = sketch[sketch['Measure'] == measure].sort_values(keys + ['Bin'], ignore_index=True)
+        groups = measure_sketch.groupby(keys, observed=True, sort=False)['PASSENGERS']
+        # Passengers are whole numbers, so their running sums reach the groups' totals exactly.
+        cumulative = groups.cumsum().to_numpy()
+        totals = groups.transform('sum').to_numpy()
+        codes = groups.ngroup().to_numpy()
+        bins = measure_sketch['Bin'].to_numpy()
+
+        measure_quantiles = measure_sketch.loc[np.flatnonzero(np.diff(codes, prepend=-1)), keys].reset_index(drop=True)
+        for name, quantile in QUANTILES.items():
+            reached = np.flatnonzero(cumulative >= quantile * totals)
+            first = reached[np.unique(codes[reached], return_index=True)[1]]
+            measure_quantiles[f'{measure} {name}'] = _bin_values(bins[first], minimum)
+        quantiles = measure_quantiles if quantiles is None else quantiles.merge(measure_quantiles, how='outer', on=keys)
+    return quantiles
+
+
+def _bins(values, minimum):
+    # Bin i > 0 holds the values in (minimum * gamma^(i - 1), minimum * gamma^i]; values past the last bin are put in it.
+    bins = np.ceil(np.log(np.maximum(values, minimum) / minimum) / np.log(_GAMMA))
+    return np.minimum(bins, _BINS - 1).astype('int16')
+
+
+def _bin_values(bins, minimum):
+    # The value within the relative accuracy of both ends of the bin; the first bin stands for nothing paid.
+    return np.where(bins == 0, 0.0, minimum * 2 * _GAMMA ** bins.astype('float64') / (_GAMMA + 1))
@@ -0,0 +1,148 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from cache import DataFileCache
+from main import DB1B
+from writers import OUTPUT_FORMATS
+
+
+class ScenarioSweep:
+    """Enriches one dataset under several configurations, or scenarios.
+
+    The input files are read and consolidated once.  Each scenario overrides parts of the configuration, and only the
+    stages its overrides affect are recomputed: the daily passenger and revenue values when the extra seats, ancillary
+    revenue, or metro areas change, and the share filter when its thresholds or the metro areas change.  Scenarios that
+    override only the filters at end or the flow validation thresholds filter the base's enrichment again; the others
+    are enriched, in parallel worker processes.
+    """
+
+    _REFILTERED_SECTIONS = ['Filters at end', 'Passenger flow validation']
+
+    def __init__(self, scenarios, input_paths, output_dir=None, combined_path=None, parallel=False, workers=None,
+                 chunk_size=None, cache_dir=None, cache_max_size_mb=DataFileCache.DEFAULT_MAX_SIZE_MB, output_format=None,
+                 float_precision=None):
+        assert len(scenarios) > 0
+        assert (output_dir is None) != (combined_path is None)
+        assert all(os.sep not in name for name in scenarios)
+        assert workers is None or workers > 0
+        self._output_dir = output_dir
+        self._combined_path = combined_path
+        self._workers = workers
+        # Outputs in an output directory are CSVs unless another format is given.
+        self._output_format = output_format or (None if output_dir is None else 'csv')
+        self._base = DB1B(combined_path or os.path.join(output_dir, f'base.{self._output_format}'), input_paths,
+                          chunk_size=chunk_size, parallel=parallel, workers=workers, cache_dir=cache_dir,
+                          cache_max_size_mb=cache_max_size_mb, output_format=self._output_format,
+                          float_precision=float_precision)
+        self._scenarios = scenarios
+        for overrides in self._scenarios.values():
+            self._scenario(overrides)
+        self._consolidated_df = None
+        self._quarters = None
+
+    def run(self):
+        self._consolidated_df, self._quarters = self._base.ingest()
+        self._report_flow_validations(self._base.flow_validation_report())
+        if any(all(section in self._REFILTERED_SECTIONS for section in overrides) for overrides in self._scenarios.values()):
+            # Enriched here, so that the scenarios that only filter its enrichment again do not each enrich the data
+            self._base.enrich_frames(self._consolidated_df, self._quarters)
+        else:
+            self._base.prepare_frames(self._consolidated_df, self._quarters)
+
+        if self._output_dir is not None:
+            os.makedirs(self._output_dir, exist_ok=True)
+        workers = min(self._workers or os.cpu_count() or 1, len(self._scenarios))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_initialize_worker, initargs=(self,)) as executor:
+            results = dict(zip(self._scenarios, executor.map(_run_scenario, self._scenarios)))
+
+        if self._combined_path is not None:
+            combined_df = pd.concat(results, names=['Scenario'])
+            self._base.write(combined_df)
+
+    def _enrich_scenario(self, name):
+        db1b = self._scenario(self._scenarios[name])
+        return db1b.enrich_frames(self._consolidated_df, self._quarters, base=self._base)
+
+    def _report_flow_validations(self, report):
+        # The base's report is reflagged for each scenario that overrides the flow validation thresholds.
+        if report is None:
+            return
+        for name, overrides in self._scenarios.items():
+            db1b = self._scenario(overrides)
+            if db1b.configuration['Passenger flow validation'] != self._base.configuration['Passenger flow validation']:
+                print(f'Scenario {name}:')
+                db1b.report_flow_validations(report)
+
+    def _scenario(self, overrides):
+        # Data files are read once with the base configuration, so scenarios cannot change how they are read.
+        return self._base.configured(_merge_overrides(self._base.configuration, overrides))
+
+    def _write_scenario(self, name, df):
+        if self._output_dir is None:
+            return df
+        self._base.write(df, os.path.join(self._output_dir, f'{name}.{self._output_format}'))
+        return None
+
+
+def _initialize_worker(sweep):
+    # Each worker process receives the consolidated data once, rather than once per scenario.
+    global _sweep
+    _sweep = sweep
+
+
+def _merge_overrides(configuration, overrides):
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(configuration.get(key), dict):
+            _merge_overrides(configuration[key], value)
+        else:
+            configuration[key] = value
+    return configuration
+
+
+def _run_scenario(name):
+    return _sweep._write_scenario(name, _sweep._enrich_scenario(name))
+
+
+_sweep = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Enrich DB1B market data under several configurations.')
+    parser.add_argument('scenarios_path',
+                        help='path to a JSON object mapping each scenario name to the configuration it overrides')
+    parser.add_argument('input_paths', nargs='+',
+                        help='paths to DB1B market data files, or directories of them or glob patterns matching them')
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument('--output-dir', default=None, help='directory to write one output per scenario to')
+    output.add_argument('--combined', default=None,
+                        help='path to write a single output to, with a Scenario column identifying each row')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default=None,
+                        help='format to write the outputs in (default: CSV, or from the --combined path\'s extension)')
+    parser.add_argument('--float-precision', type=int, default=None,
+                        help='significant digits to write floats to in CSV outputs (default: full precision)')
+    parser.add_argument('--parallel', action='store_true', help='ingest input files in parallel worker processes')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes to use (default: number of CPUs)')
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help='read each input file this many rows at a time to bound memory use')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory in which to cache consolidated input files between runs')
+    parser.add_argument('--cache-max-size', type=int, default=DataFileCache.DEFAULT_MAX_SIZE_MB,
+                        help='size in MB above which the least recently used cache entries are evicted')
+    args = parser.parse_args()
+
+    with open(args.scenarios_path) as f:
+        scenarios = json.load(f)
+    sweep = ScenarioSweep(scenarios, args.input_paths, output_dir=args.output_dir, combined_path=args.combined,
+                          parallel=args.parallel, workers=args.workers, chunk_size=args.chunk_size,
+                          cache_dir=args.cache_dir, cache_max_size_mb=args.cache_max_size,
+                          output_format=args.output_format, float_precision=args.float_precision)
+    sweep.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+
+
+class FlowValidationError(Exception):
+    """Raised in strict mode when a data file has routes with concerningly uneven passenger flows."""
+
+
+def validate_flows(df, days, quantity_different, percent_different):
+    """Compares the passengers flown in each direction of each airport pair in consolidated data.
+
+    Airports are coded as integers in sorted order and each pair is coded from its lower and higher airport, so the two
+    directions of a route are summed into the same pair by bincount rather than matched by name.  Returns one row per
+    pair, oriented from the alphabetically lower airport, with the passengers per day flown in each direction, their
+    difference, and whether the difference exceeds both thresholds.
+    """
+    origins, destinations = df['ORIGIN'].to_numpy(dtype=object), df['DEST'].to_numpy(dtype=object)
+    airports = pd.Index(pd.unique(np.concatenate([origins, destinations]))).sort_values()
+    origins, destinations = airports.get_indexer(origins), airports.get_indexer(destinations)
+    passengers = df['PASSENGERS'].to_numpy(dtype='float64')
+
+    routes = origins != destinations
+    origins, destinations, passengers = origins[routes], destinations[routes], passengers[routes]
+    pairs, pair_codes = np.unique(np.minimum(origins, destinations).astype(np.int64) * len(airports) +
+                                  np.maximum(origins, destinations), return_inverse=True)
+    forward = origins < destinations
+    # Passengers are whole numbers, so their sums are exact and only the rates are rounded.
+    right = np.bincount(pair_codes, weights=np.where(forward, passengers, 0), minlength=len(pairs)) / (0.1 * days)
+    left = np.bincount(pair_codes, weights=np.where(forward, 0, passengers), minlength=len(pairs)) / (0.1 * days)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent_diff = right / left - 1
+    diff = right - left
+    lower, higher = airports[pairs // len(airports)], airports[pairs % len(airports)]
+    report = pd.DataFrame({
+        'Route': lower + '-' + higher,
+        'Origin': lower,
+        'Destination': higher,
+        'Origin to destination pax/day': right,
+        'Destination to origin pax/day': left,
+        'Diff': diff,
+        'Percent diff': percent_diff,
+    })
+    report['Concerning'] = concerning_flows(report, quantity_different, percent_different)
+    return report
+
+
+def concerning_flows(report, quantity_different, percent_different):
+    """Flags the routes of a flow validation report whose difference exceeds both thresholds."""
+    percent_different = percent_different if -1 < percent_different < 1 else percent_different / 100.0
+    return (report['Diff'].abs() > quantity_different) & (report['Percent diff'].abs() > percent_different)
@@ -0,0 +1,60 @@
+import os
+
+
+class CsvWriter:
+    """Writes the output as CSV, a chunk of rows at a time, with floats at full or at a given precision."""
+
+    DEFAULT_CHUNK_ROWS = 50000
+
+    def __init__(self, float_precision=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+        assert float_precision is None or float_precision > 0
+        assert chunk_rows > 0
+        self._float_format = f'%.{float_precision}g' if float_precision is not None else None
+        self._chunk_rows = chunk_rows
+
+    def write(self, df, path, columns=None):
+        with open(path, 'w', newline='') as f:
+            # The header is written with the first chunk, so it is also written when there are no rows.
+            for start in range(0, max(len(df), 1), self._chunk_rows):
+                df.iloc[start:start + self._chunk_rows].to_csv(f, columns=columns, header=start == 0,
+                                                                float_format=self._float_format)
+
+
+class ArrowWriter:
+    """Writes the output in a typed columnar format, keeping categorical columns as dictionary-encoded columns.
+
+    The output's index is kept as a column, as it is in the CSV output.  Requires `pyarrow`.
+    """
+
+    FORMATS = ['arrow', 'feather', 'parquet']
+
+    def __init__(self, output_format):
+        assert output_format in self.FORMATS
+        self._format = output_format
+
+    def write(self, df, path, columns=None):
+        import pyarrow as pa
+        import pyarrow.feather
+        import pyarrow.parquet
+
+        table = pa.Table.from_pandas(df, columns=columns, preserve_index=True)
+        if self._format == 'parquet':
+            pyarrow.parquet.write_table(table, path)
+        elif self._format == 'feather':
+            pyarrow.feather.write_feather(table, path)
+        else:
+            with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+
+OUTPUT_FORMATS = ['csv'] + ArrowWriter.FORMATS
+
+
+def output_writer(path, output_format=None, float_precision=None):
+    # The format is given explicitly or by the path's extension, eg., .parquet
+    output_format = output_format or os.path.splitext(path)[1].lstrip('.').lower()
+    assert output_format in OUTPUT_FORMATS, f'Unknown output format {output_format}; expected one of {OUTPUT_FORMATS}'
+    if output_format == 'csv':
+        return CsvWriter(float_precision)
+    assert float_precision is None, f'Float precision only applies to CSV output, not to {output_format}'
+    return ArrowWriter(output_format)